@@ -1,18 +1,24 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pprint import pprint
 
 import pandas as pd
-import requests
 import yaml
-from bs4 import BeautifulSoup
 from tqdm import tqdm
 
+import tables
 from categories import categories
+from downloads import DownloadManager
 from fileutils import read_json_cache, write_json_cache
 from google_sync import NCSEFGoogleDrive
+from async_client import AsyncClient
+from blobs import BlobStore
+from http_cache import ResponseCache, SessionPool
 from logstuff import get_logger
-from utils import headers
+from manifest import Manifest
+from pipeline import Pipeline
 
 pd.set_option('display.max_columns', None)
 
@@ -21,7 +27,11 @@ class STEMWizardAPI(object):
     from get_data import export_list, export_report
     from get_data import download_file_from_url_via_get, download_from_stemwizard_via_post
     from get_data import download_file_from_url_via_get, download_from_stemwizard_via_post
-    from utils import get_region_info, get_csrf_token, _merge_dicts, _download_to_local_file_path
+    from get_data import _stemwizard_download_request
+    from get_data import _s3_validator_headers
+    from utils import get_region_info, get_csrf_token, _headers, _request, _merge_dicts, _fingerprint_students
+    from utils import _local_file_path, _download_to_local_file_path, _scrape_csrf, _save_login_state, _restore_login_state
+    from utils import _fetch_by_category, _iter_pages
 
     def __init__(self, configfile='stemwizardapi.yaml', login_stemwizard=True, login_google=True):
         '''
@@ -30,18 +40,49 @@ class STEMWizardAPI(object):
         :param configfile: configfile: (default to stemwizardapi.yaml)
         '''
         self.authenticated = None
-        self.session = requests.Session()  # shared session, maintains cookies throughout
+        self.sessions = None
+        self.aio = None
+        self.manifest = None
         self.region_domain = 'unknown'
         self.parent_file_dir = 'files'
         self.region_id = None
         self.csrf = None
         self.username = None
         self.password = None
+        self.upload_workers = 4
+        self.scrape_workers = 3  # concurrent requests to STEM Wizard, keep this small, see throttling in the README
+        self.download_workers = 6  # concurrent requests to other hosts, S3 file downloads
+        self.stemwizard_download_workers = 2  # concurrent fileDownload posts, within scrape_workers
+        self.download_retries = 3
+        self.page_size = 100  # rows per page requested from STEM Wizard lists
+        self.page_limits = {}  # per_page cap learned for each list, see _iter_pages
+        self.upload_chunk_size = 8 * 1024 * 1024
+        self.google_drive_root = '/Automation'
+        self.http_cache_max_mb = 256
+        self.http_cache_ttls = None  # seconds fresh by URL substring, None for http_cache.DEFAULT_TTLS
+        self.http_pool_size = 10  # keep-alive connections per session, enough for every worker
+        self.session_max_age = 3600  # seconds a saved STEM Wizard login is tried before logging in again
+        self.session_cache_file = None
+        self.manifest_file = None  # every downloaded file, where it came from, its size, hash and S3 validators
+        self.read_config(configfile)
+        if self.session_cache_file is None:
+            self.session_cache_file = f'caches/{self.domain}_session.json'
+        if self.manifest_file is None:
+            self.manifest_file = f'caches/{self.domain}_manifest.sqlite'
+        # duplicate downloads are hardlinked to one copy of their content
+        self.blobs = BlobStore(f'{self.parent_file_dir}/blobs')
+        self.manifest = Manifest(self.manifest_file, root=f'{self.parent_file_dir}/{self.domain}', blobs=self.blobs)
+        # one session per thread sharing cookies, so a single login serves them all, and cached responses
+        cache = ResponseCache(max_bytes=self.http_cache_max_mb * 1024 * 1024, ttls=self.http_cache_ttls,
+                              identity=f'{self.domain}/{self.username}')
+        self.sessions = SessionPool(cache, size=self.http_pool_size)
+        # login, scraping and downloads share one event loop and the same cookies
+        self.aio = AsyncClient(cache, self.sessions.cookies, host_limits={'stemwizard.com': self.scrape_workers},
+                               default_limit=self.download_workers)
         if login_google:
-            self.googleapi = NCSEFGoogleDrive()
+            self.googleapi = NCSEFGoogleDrive(chunk_size=self.upload_chunk_size, root=self.google_drive_root)
         else:
             self.googleapi = None
-        self.read_config(configfile)
         self.logger = get_logger(self.domain)
         if self.username is None or len(self.username) < 6:
             raise ValueError(f'did not find a valid username in {configfile}')
@@ -49,19 +90,58 @@ class STEMWizardAPI(object):
             raise ValueError(f'did not find a valid password in {configfile}')
         self.url_base = f'https://{self.domain}.stemwizard.com'
 
-        self.get_region_info()
+        self.aio.reauthenticate = self._relogin
 
-        if login_stemwizard:
-            self.authenticated = self.login()
+        if self._restore_login_state(probe=login_stemwizard):
+            self.authenticated = True if login_stemwizard else None
         else:
-            self.authenticated = None
+            self.get_region_info()
+            if login_stemwizard:
+                self.authenticated = self.login()
+            else:
+                self.authenticated = None
 
         if self.region_domain != self.domain:
             raise ValueError(
                 f'STEM Wizard returned a region domain of {self.region_domain}, which varies from the {self.domain} value in the config file')
 
+    def close(self):
+        '''
+        stops the async client's event loop and closes the sessions, HTTP cache and manifest.  Call this when done, or
+        use the object in a with statement.
+        '''
+        if self.aio is not None:
+            self.aio.close()
+            self.aio = None
+        if self.sessions is not None:
+            self.sessions.close()
+            self.sessions = None
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __del__(self):
-        self.session.close()
+        # never wait on the loop thread from a finalizer, at shutdown it may be gone already.  It is a daemon, so
+        # asking it to stop is as much as is needed.
+        aio = getattr(self, 'aio', None)
+        if aio is not None:
+            try:
+                aio.loop.call_soon_threadsafe(aio.loop.stop)
+            except RuntimeError:
+                pass
+
+    @property
+    def session(self):
+        '''
+        the calling thread's session, all of them share cookies so it is authenticated once any of them is
+        '''
+        return self.sessions.get()
 
     def read_config(self, configfile):
         """
@@ -74,6 +154,21 @@ class STEMWizardAPI(object):
         self.domain = data_loaded['domain']
         self.username = data_loaded['username']
         self.password = data_loaded['password']
+        self.upload_workers = data_loaded.get('upload_workers', self.upload_workers)
+        self.scrape_workers = data_loaded.get('scrape_workers', self.scrape_workers)
+        self.download_workers = data_loaded.get('download_workers', self.download_workers)
+        self.stemwizard_download_workers = data_loaded.get('stemwizard_download_workers',
+                                                           self.stemwizard_download_workers)
+        self.download_retries = data_loaded.get('download_retries', self.download_retries)
+        self.page_size = data_loaded.get('page_size', self.page_size)
+        self.upload_chunk_size = data_loaded.get('upload_chunk_size', self.upload_chunk_size)
+        self.google_drive_root = data_loaded.get('google_drive_root', self.google_drive_root)
+        self.http_cache_max_mb = data_loaded.get('http_cache_max_mb', self.http_cache_max_mb)
+        self.http_cache_ttls = data_loaded.get('http_cache_ttls', self.http_cache_ttls)
+        self.http_pool_size = data_loaded.get('http_pool_size', self.http_pool_size)
+        self.session_max_age = data_loaded.get('session_max_age', self.session_max_age)
+        self.session_cache_file = data_loaded.get('session_cache_file', self.session_cache_file)
+        self.manifest_file = data_loaded.get('manifest_file', self.manifest_file)
         fp.close()
 
     def login(self):
@@ -93,8 +188,8 @@ class STEMWizardAPI(object):
 
         url_login = f'{self.url_base}/admin/authenticate'
 
-        rp = self.session.post(url_login, data=payload, headers=headers,
-                               allow_redirects=True)  # , cookies=session_cookies)
+        rp = self._request('POST', url_login, data=payload, headers=self._headers(),
+                           allow_redirects=True, reauthenticate=False)  # , cookies=session_cookies)
         if rp.status_code >= 300:
             self.logger.error(f"status code {rp.status_code} on post to {url_login}")
             return
@@ -108,80 +203,115 @@ class STEMWizardAPI(object):
             self.logger.error(f"failed to authenticate to {self.domain}")
 
         self.get_csrf_token()
+        if authenticated:
+            self._save_login_state()
 
         return authenticated
 
-    def _student_file_detail(self, studentId, info_id):
-        ''' fetches info about a given studentID (project really) '''
-        self.get_csrf_token()
+    def _relogin(self):
+        '''
+        logs in from scratch after STEM Wizard expired the session, called by the async client
+
+        :return: the new CSRF token and _token
+        '''
+        self.sessions.cookies.clear()
+        self.csrf = None
+        self.get_region_info()
+        self.authenticated = self.login()
+        return self.csrf, self.token
+
+    def _file_detail_request(self, studentId, info_id):
+        '''
+        :return: concurrent.futures.Future of the files and forms detail view, fetched on the async client's loop
+        '''
         url = f'{self.url_base}/filesAndForms/studentFormsAndFilesDetailedView'
         payload = {'studentId': studentId, 'info_id': info_id}
+        headers = self._headers(referer=f'{self.url_base}/filesAndForms', xhr=True, csrf=True)
+        return self.aio.submit(self.aio.request('POST', url, data=payload, headers=headers))
+
+    def _parse_file_detail(self, text):
+        ''' rows of the file table on the files and forms detail view of one team member '''
+        data = []
+        # <table class="table table-striped table-bordered table-hover dataTable" style="width:100%;position: relative;border:1px solid #e4e4e4">
+        for th_labels, tds, tr in tables.iter_table(text, table_class=tables.DETAIL_TABLE_CLASS):
+            row = {}
+            for label, td in zip(th_labels, tds):
+                l = td.find('.//a')
+                if l is not None:
+                    # <a href="#" title="Download" downloadprojfile="McMichael Student Checklist.jpg" downloadprojfilename="McMichael Student Checklist_67263_164437473362.jpg" uploaddocname="https://stem-s3-2021.s3.us-west-1.amazonaws.com/2021/production/project_files/McMichael Student Checklist_67263_164437473362.jpg" class="downloadProjStudent" id="downloadProjStudent" style="text-decoration:none">                            McMichael Student Checklist.jpg</a>
+                    if l.get('uploaddocname') is not None:
+                        # downloadable from s3 bucket
+                        row[label] = {'url': l.get('uploaddocname'), 'remote_filename': l.get('downloadprojfilename')}
+                    else:
+                        # downloadable from STEM Wizard site
+                        row[label] = {'remote_filename': l.get('uploaded_file_name')}
+
+                else:
+                    contents = tables.cell_text(td)
+                    if label == 'FILE TYPE':
+                        contents = tables.file_type(contents)
+                    row[label] = contents.strip()
+            if len(row):
+                data.append(row)
+        return data
 
-        headers['X-CSRF-TOKEN'] = self.csrf
-        headers['Referer'] = f'{self.url_base}/filesAndForms'
-        headers['X-Requested-With'] = 'XMLHttpRequest'
-        rfaf = self.session.post(url, data=payload, headers=headers)
+    def _student_file_detail(self, studentId, info_id):
+        ''' fetches info about a given studentID (project really), every team member's when info_id is None '''
+        if info_id is None:
+            return self._student_file_details([studentId])[studentId]
+        self.get_csrf_token()
+        rfaf = self._file_detail_request(studentId, info_id).result()
         if rfaf.status_code >= 300:
-            self.logger.error(f"status code {rfaf.status_code} on post to {url}")
+            self.logger.error(f"status code {rfaf.status_code} on post to {rfaf.url}")
             return
-        if info_id is None:
-            self.logger.debug(f"getting student info ids for  {studentId}")
-            # fp = open('foo.html', 'w')
-            # fp.write(rfaf.text)
-            # fp.close()
-            soup = BeautifulSoup(rfaf.text, 'html.parser')
-            # <li class="student_tab" id="64585">
-            students = soup.find_all('li', {'class': 'student_tab'})
-            data = {}
-            for student in students:
-                infoid = student['id']
-                if infoid is not None:
-                    data[f"{studentId} {infoid}"] = self._student_file_detail(studentId, infoid)
-        else:
-            self.logger.debug(f"getting file info for {studentId} {info_id}")
-            data = []
-            soup = BeautifulSoup(rfaf.text, 'html.parser')
-            # <table class="table table-striped table-bordered table-hover dataTable" style="width:100%;position: relative;border:1px solid #e4e4e4">
-            thetable = soup.find('table', {'class': "table table-striped table-bordered table-hover dataTable"})
-            # thead = thetable.find('thead')
-            th_labels = []
-            for th in thetable.find_all('th'):
-                th_labels.append(th.text)
-            # tbody = thetable.find('tbody')
-            for tr in thetable.find_all('tr'):
-                row = {}
-                for label, td in zip(th_labels, tr.find_all('td')):
-                    l = td.find('a')
-                    if l is not None:
-                        # <a href="#" title="Download" downloadprojfile="McMichael Student Checklist.jpg" downloadprojfilename="McMichael Student Checklist_67263_164437473362.jpg" uploaddocname="https://stem-s3-2021.s3.us-west-1.amazonaws.com/2021/production/project_files/McMichael Student Checklist_67263_164437473362.jpg" class="downloadProjStudent" id="downloadProjStudent" style="text-decoration:none">                            McMichael Student Checklist.jpg</a>
-                        if l.has_attr('uploaddocname'):
-                            # downloadable from s3 bucket
-                            row[label] = {'url': l['uploaddocname'], 'remote_filename': l['downloadprojfilename']}
-                        else:
-                            # downloadable from STEM Wizard site
-                            row[label] = {'remote_filename': l['uploaded_file_name']}
+        self.logger.debug(f"getting file info for {studentId} {info_id}")
+        return self._parse_file_detail(rfaf.text)
 
-                    else:
-                        contents = td.text
-                        if label == 'FILE TYPE':
-                            # normalize file types
-                            contents = contents.replace('2022 NCSEF ', '')
-                            contents = contents.replace('Abstract Form', 'Abstract')
-                            contents = contents.replace('ISEF ', 'ISEF-')
-                            if 'Research Plan' in contents:
-                                contents = 'Research Plan'
-                        row[label] = contents.strip()
-                if len(row):
-                    data.append(row)
+    def _student_file_details(self, studentIds):
+        '''
+        fetches the files and forms detail of many projects at once.  Each project's team member tabs are requested up
+        front, and each member's detail as soon as its project's tabs are known, so a batch is bounded by the STEM
+        Wizard concurrency limit rather than made one request at a time.
+
+        :param studentIds: list of student ids (projects really)
+        :return: dictionary by student id of dictionaries of rows by "studentId info_id", None where a request failed
+        '''
+        self.get_csrf_token()
+        tabs = {studentId: self._file_detail_request(studentId, None) for studentId in studentIds}
+        data = {}
+        details = {}
+        for studentId, future in tabs.items():
+            rfaf = future.result()
+            if rfaf.status_code >= 300:
+                self.logger.error(f"status code {rfaf.status_code} on post to {rfaf.url}")
+                data[studentId] = None
+                continue
+            self.logger.debug(f"getting student info ids for  {studentId}")
+            data[studentId] = {}
+            for infoid in tables.student_tab_ids(rfaf.text):
+                details[(studentId, infoid)] = self._file_detail_request(studentId, infoid)
+        for (studentId, infoid), future in details.items():
+            rfaf = future.result()
+            if rfaf.status_code >= 300:
+                self.logger.error(f"status code {rfaf.status_code} on post to {rfaf.url}")
+                data[studentId][f"{studentId} {infoid}"] = None
+                continue
+            self.logger.debug(f"getting file info for {studentId} {infoid}")
+            data[studentId][f"{studentId} {infoid}"] = self._parse_file_detail(rfaf.text)
         return data
 
-    def studentSync(self, cache_file_name='caches/student_data.json', download=True, upload=True, refresh=False, force=False):
+    def studentSync(self, cache_file_name='caches/student_data.json', download=True, upload=True, refresh=False, force=False,
+                    fingerprint_file_name='caches/student_fingerprints.json', revalidate=False):
         '''
         sync student files from STEM Wizard to local filesystem and then up to Google Drive
 
         :param cache_file_name: filename
         :param download: download files from AWS and STEM Wizard (default True)
         :param upload:upload files to GoogleDrive (default True)
+        :param refresh: re-scrape the milestones, then only merge, download and upload students whose rows changed
+        :param force: download every file, and process every student even on refresh
+        :param fingerprint_file_name: per student hashes of the milestone rows as of the last download and upload
+        :param revalidate: check every student's S3 files for re-uploads under the same name, see sync_files_locally
         :return: dictionary of projects and their metadata
         '''
         if download and not self.authenticated:
@@ -204,19 +334,50 @@ class STEMWizardAPI(object):
         # fetch data from project, forms and files, and files for judges tabs on milestones page,
         # by div/category for performance
         self.logger.info('refreshing local data caches as necessary')
-        data = {}
-        for k, v in threads.items():
+
+        if refresh:
+            # a forced refresh has to see the live milestones, not cached responses
+            self.sessions.cache.invalidate('getstudentCustomMilestoneDetailView')
+
+        def refresh_milestone(v):
             if refresh:
                 v['max_cache_age'] = 0
-            data[k] = read_json_cache(v['cachefile'], max_cache_age=v['max_cache_age'])
-            if len(data[k]) == 0:
-                data[k] = v['function']()
-                write_json_cache(data[k], v['cachefile'])
+            milestone_data = read_json_cache(v['cachefile'], max_cache_age=v['max_cache_age'])
+            if len(milestone_data) == 0:
+                milestone_data = v['function']()
+                write_json_cache(milestone_data, v['cachefile'])
+            return milestone_data
+
+        # the three milestones are independent until merged, fetch them side by side
+        data = {}
+        stale = []  # milestones which couldn't be refreshed, their students' rows may not be current
+        with ThreadPoolExecutor(max_workers=len(threads)) as pool:
+            futures = {k: pool.submit(refresh_milestone, v) for k, v in threads.items()}
+            for k, future in futures.items():
+                try:
+                    data[k] = future.result()
+                except Exception as e:
+                    # keep going with whatever was last cached for this milestone rather than lose the others
+                    self.logger.error(f'failed to refresh {k} milestone data: {e}')
+                    data[k] = read_json_cache(threads[k]['cachefile'], max_cache_age=99999999999)
+                    stale.append(k)
+
+        # on refresh, students whose rows are unchanged since the last complete sync carry over as they were
+        fingerprints = self._fingerprint_students(data)
+        previous = {}
+        if refresh and not force and not revalidate:  # a re-upload to the same S3 key leaves the rows unchanged
+            previous = read_json_cache(cache_file_name, max_cache_age=99999999999)
+        if len(previous):
+            synced = read_json_cache(fingerprint_file_name, max_cache_age=99999999999)
+            changed = {studentid for studentid, fingerprint in fingerprints.items()
+                       if synced.get(studentid) != fingerprint or studentid not in previous}
+            self.logger.info(f'{len(changed)} of {len(fingerprints)} students changed since the last sync')
+            data = {k: {studentid: v for studentid, v in milestone_data.items() if studentid in changed}
+                    for k, milestone_data in data.items()}
 
         self.logger.info('merging file information')
         # combine dictionaries into a single view of student metadata
         data = self._merge_dicts(data)
-        write_json_cache(data['all'], 'caches/student_data.json')
 
         # # code around bug on milestones page which fails to differentiate files uploaded by separate team members.
         # data['fixed'] = read_json_cache('caches/student_data_fixed.json', max_cache_age=9000)
@@ -227,20 +388,50 @@ class STEMWizardAPI(object):
         # write_json_cache(data['all'], 'caches/student_data_unpatched.json')
         # data['all'] = data['fixed']
 
-        # generate local names for the files and forms
-        self.logger.info('checking local copies of these files')
-        data['localized'] = self.analyze_local_files(data['all'])
-        write_json_cache(data['localized'], 'caches/student_data.json')
-
-        if download:
-            self.logger.info('synching to local filesystem')
-            self.sync_files_locally(data['localized'], force=force)
+        if download and upload:
+            # each file is localized, downloaded and uploaded as soon as it can be, see sync_files_pipelined
+            self.logger.info('synching to local filesystem and Google Drive')
+            failed = self.sync_files_pipelined(data['all'], force=force, revalidate=revalidate)
+            data['localized'] = data['all']
+            if not len(previous):
+                write_json_cache(data['localized'], cache_file_name)
         else:
-            self.logger.info('not synching to local filesystem')
-
-        if upload:
-            self.logger.info('synching to Google Drive')
-            data['localized'] = self.sync_to_google(data['all'])
+            # generate local names for the files and forms
+            self.logger.info('checking local copies of these files')
+            data['localized'] = self.analyze_local_files(data['all'])
+            if not len(previous):  # otherwise these are just the changed students, written once merged below
+                write_json_cache(data['localized'], cache_file_name)
+
+            if download:
+                self.logger.info('synching to local filesystem')
+                self.sync_files_locally(data['localized'], force=force, revalidate=revalidate)
+            else:
+                self.logger.info('not synching to local filesystem')
+
+            if upload:
+                self.logger.info('synching to Google Drive')
+                data['localized'] = self.sync_to_google(data['all'])
+
+        if len(previous):
+            # students no longer on the milestones drop out
+            localized = {studentid: v for studentid, v in previous.items() if studentid in fingerprints}
+            localized.update(data['localized'])
+            data['localized'] = localized
+            write_json_cache(data['localized'], cache_file_name)
+        if download and upload and len(stale):
+            # fingerprints of stale rows would hide the changes still to come from them
+            self.logger.warning(f'not updating student fingerprints, {", ".join(stale)} milestone data is stale')
+        elif download and upload:
+            # only students whose files all synced count as synced, the others are retried next time
+            synced = {studentid: fingerprint for studentid, fingerprint in
+                      read_json_cache(fingerprint_file_name, max_cache_age=99999999999).items()
+                      if studentid in fingerprints}
+            for studentid, fingerprint in fingerprints.items():
+                if studentid in failed:
+                    synced.pop(studentid, None)
+                elif studentid in data['all']:  # skipped as unchanged otherwise, already synced
+                    synced[studentid] = fingerprint
+            write_json_cache(synced, fingerprint_file_name)
 
         return data['localized']
 
@@ -274,6 +465,7 @@ class STEMWizardAPI(object):
             for filetype, filedata in v['files'].items():
                 # ELE-BIOS-001_Participant Signature Page.pdf
                 prefix = filetype
+                sources = []  # remote filename of each local filename, for files without an S3 url
                 for remote_filename, lastname, firstname in zip(filedata['remote_filename'], v['Last Name'],
                                                                 v['First Name']):
                     if len(remote_filename) == 0:
@@ -285,10 +477,15 @@ class STEMWizardAPI(object):
                     atoms = remote_filename.split('.')
                     filedata['local_filename'].append(
                         f"{div}/{cat}/{project_number}/{project_number}_{prefix}.{atoms[-1]}")
-                for filepath in filedata['local_filename']:
-                    fullpath = f"files/ncsef/{filepath}"
-                    if os.path.exists(fullpath):
-                        filedata['local_lastmod'].append(datetime.fromtimestamp(os.path.getmtime(fullpath)))
+                    sources.append(remote_filename)
+                for n, filepath in enumerate(filedata['local_filename']):
+                    entry = self.manifest.get(filepath)
+                    if entry is None and os.path.exists(f"{self.manifest.root}/{filepath}"):
+                        # downloaded before there was a manifest, adopt it, verify_files() hashes it
+                        source = filedata['url'][n] if n < len(filedata['url']) else sources[n]
+                        entry = self.manifest.record(filepath, project_number, filetype, source, md5=False)
+                    if entry is not None:
+                        filedata['local_lastmod'].append(datetime.fromtimestamp(entry['mtime']))
                     else:
                         filedata['local_lastmod'].append(None)
         return data
@@ -305,15 +502,21 @@ class STEMWizardAPI(object):
         for d in data.values():
             byp[d['Project Number']] = d
 
-        for projectnumber in tqdm(sorted(byp.keys()), desc="sync to google"):
+        uploads = []
+        for projectnumber in sorted(byp.keys()):
             v = byp[projectnumber]
             for filetype, filedata in v['files'].items():
                 for (local_filename, local_lastmod) in zip(filedata['local_filename'], filedata['local_lastmod']):
                     if filetype in ['Abstract Form', '1C', '7']:  # duplicated on judge screen
                         continue
                     remote_filename = f"/Automation/ncsef/by project/{local_filename}"
-                    if os.path.exists(f"files/ncsef/{local_filename}"):
-                        self.googleapi.create_file(f"files/ncsef/{local_filename}", remote_filename)
+                    if self.manifest.get(local_filename) is not None:
+                        uploads.append((f"{self.manifest.root}/{local_filename}", remote_filename))
+        # content already uploaded under another path is copied on Drive rather than sent again
+        failed = self.googleapi.upload_files(uploads, max_workers=self.upload_workers, update_on='checksum',
+                                             desc="sync to google", md5s=self.manifest.md5s())
+        if len(failed):
+            self.logger.error(f"{len(failed)} of {len(uploads)} uploads to Google Drive failed")
 
         # symposium links
         self.googleapi.list_all(force=False)  # refresh cache with newly created nodes and folders
@@ -322,7 +525,7 @@ class STEMWizardAPI(object):
             for filetype, filedata in v['files'].items():
                 for (local_filename, local_lastmod) in zip(filedata['local_filename'], filedata['local_lastmod']):
                     remote_filename = f"/Automation/ncsef/by project/{local_filename}"
-                    if os.path.exists(f"files/ncsef/{local_filename}"):
+                    if self.manifest.get(local_filename) is not None:
                         if filetype in ['Abstract', 'Quad Chart', 'Project Presentation Slides', 'Research Paper',
                                         'Lab Notebook']:
                             elements = remote_filename.replace('by project', 'for symposium').split('/')
@@ -331,27 +534,159 @@ class STEMWizardAPI(object):
 
         return data
 
-    def sync_files_locally(self, data, force=True):
+    def sync_files_locally(self, data, force=True, revalidate=False):
         '''
-        iterate over projects, ensureing each file has been downloaded locally
+        iterate over projects, ensureing each file has been downloaded locally.  The downloads run concurrently,
+        within download_workers for S3 and stemwizard_download_workers for STEM Wizard, and a summary is printed.
         :param data:
-        :return: nothing
+        :param force: download every file again
+        :param revalidate: fetch S3 files already downloaded only if they changed since, with conditional GETs
+        :return: list of (local filename, reason) for downloads which failed
         '''
-        for id, v in tqdm(data.items()):
-            for filetype, filedata in v['files'].items():
-                if filetype in ['Abstract Form', '1C', '7']:  # duplicated on judge screen
-                    continue
-                if len(filedata['url']) > 0:
-                    for (url, local_filename, local_lastmod) in zip(filedata['url'], filedata['local_filename'],
-                                                                    filedata['local_lastmod']):
-                        if 'amazonaws.com' in url and (force or local_lastmod is None):
-                            self.download_file_from_url_via_get(url, local_filename)
-                else:
-                    for (remote_filename, local_filename, local_lastmod) in zip(filedata['remote_filename'],
-                                                                                filedata['local_filename'],
-                                                                                filedata['local_lastmod']):
-                        if len(remote_filename) > 0 and (force or local_lastmod is None):
-                            self.download_from_stemwizard_via_post(remote_filename, local_filename)
+        self.get_csrf_token()  # once for every STEM Wizard download
+        downloads = DownloadManager(self, s3_workers=self.download_workers,
+                                    stemwizard_workers=self.stemwizard_download_workers,
+                                    retries=self.download_retries)
+        for id, v in data.items():
+            for filetype, local_filename, job in self._student_files(downloads, v, force, revalidate):
+                if job is not None:
+                    downloads.add(job)
+        failed = downloads.run(desc='download files')
+        print(downloads.summary())
+        self.logger.info(downloads.summary())
+        return failed
+
+    def _student_files(self, downloads, v, force=False, revalidate=False):
+        '''
+        the files of one localized student, with the download each needs
+
+        :param downloads: DownloadManager to make the jobs for
+        :param v: student, after analyze_local_files
+        :param force: download every file again
+        :param revalidate: fetch S3 files already downloaded only if they changed since
+        :return: list of (filetype, local filename, download job, None if the local copy will do)
+        '''
+        files = []
+        for filetype, filedata in v['files'].items():
+            if filetype in ['Abstract Form', '1C', '7']:  # duplicated on judge screen
+                continue
+            if len(filedata['url']) > 0:
+                for (url, local_filename, local_lastmod) in zip(filedata['url'], filedata['local_filename'],
+                                                                filedata['local_lastmod']):
+                    job = None
+                    if 'amazonaws.com' in url and (force or local_lastmod is None):
+                        job = downloads.s3_job(url, local_filename, v['Project Number'], filetype)
+                    elif 'amazonaws.com' in url and revalidate:
+                        job = downloads.s3_job(url, local_filename, v['Project Number'], filetype, conditional=True)
+                    files.append((filetype, local_filename, job))
+            else:
+                for (remote_filename, local_filename, local_lastmod) in zip(filedata['remote_filename'],
+                                                                            filedata['local_filename'],
+                                                                            filedata['local_lastmod']):
+                    job = None
+                    if len(remote_filename) > 0 and (force or local_lastmod is None):
+                        job = downloads.stemwizard_job(remote_filename, local_filename, v['Project Number'],
+                                                       filetype)
+                    files.append((filetype, local_filename, job))
+        return files
+
+    def sync_files_pipelined(self, data, force=False, revalidate=False):
+        '''
+        localize, download, upload to Google Drive and link for the symposium, a file at a time.  Each stage has its
+        own workers and hands a file to the next through a bounded queue as soon as it is done with it, so a new
+        file is on Drive one download and one upload after its student is localized, and a stage which falls
+        behind slows the ones before it.
+
+        :param data: merged student data, localized in place
+        :param force: download every file again
+        :param revalidate: fetch S3 files already downloaded only if they changed since
+        :return: set of ids of the students a file of which failed to download, upload or link
+        '''
+        self.get_csrf_token()  # once for every STEM Wizard download
+        downloads = DownloadManager(self, s3_workers=self.download_workers,
+                                    stemwizard_workers=self.stemwizard_download_workers,
+                                    retries=self.download_retries)
+        uploaded = {}  # md5 -> Drive path it was uploaded to, so duplicate content is copied there instead
+        outstanding = {}  # student id -> files still in the pipeline
+        lock = threading.Lock()
+
+        def localize(item):
+            studentid, v = item
+            self.analyze_local_files({studentid: v})
+            files = [(studentid,) + file for file in self._student_files(downloads, v, force, revalidate)]
+            with lock:
+                outstanding[studentid] = len(files)
+            return files
+
+        def download(item):
+            studentid, filetype, local_filename, job = item
+            if job is not None and downloads.fetch(job) == 'failed':
+                raise IOError(f'could not download {local_filename}')
+            return [item] if self.manifest.get(local_filename) is not None else []
+
+        def upload(item):
+            # create_file and copy_file raise when Drive refuses, so a file which isn't there is never linked
+            studentid, filetype, local_filename, job = item
+            md5 = self.manifest.get(local_filename)['md5']
+            localpath = f"{self.manifest.root}/{local_filename}"
+            remote_filename = f"/Automation/ncsef/by project/{local_filename}"
+            with lock:
+                source = uploaded.get(md5)
+            if source is None:
+                self.googleapi.create_file(localpath, remote_filename, update_on='checksum', md5=md5)
+                if md5 is not None:
+                    with lock:
+                        uploaded.setdefault(md5, remote_filename)
+            else:
+                self.googleapi.copy_file(localpath, source, remote_filename, update_on='checksum', md5=md5)
+            return [(studentid, filetype, remote_filename)]
+
+        def shortcut(item):
+            studentid, filetype, remote_filename = item
+            if filetype in ['Abstract', 'Quad Chart', 'Project Presentation Slides', 'Research Paper',
+                            'Lab Notebook']:
+                elements = remote_filename.replace('by project', 'for symposium').split('/')
+                self.googleapi.create_shortcut(remote_filename, '/'.join(elements[:-1]), elements[-1])
+            return []
+
+        def finished(stage, item):
+            # a student is done once the last of its files is, or straight away if it had none
+            if stage != 'localize':
+                with lock:
+                    outstanding[item[0]] -= 1
+                    if outstanding[item[0]] > 0:
+                        return
+            bar.update(1)
+
+        pipeline = Pipeline()
+        pipeline.stage('localize', localize)
+        pipeline.stage('download', download, workers=self.download_workers + self.stemwizard_download_workers)
+        pipeline.stage('upload', upload, workers=self.upload_workers)
+        pipeline.stage('shortcut', shortcut)
+        with tqdm(total=len(data), desc='sync students') as bar:
+            failed = pipeline.run(list(data.items()), finished=finished)
+        self.googleapi.list_all(force=False)  # saves the nodes created along the way
+        print(downloads.summary())
+        self.logger.info(downloads.summary())
+        # every stage's items start with the student id
+        failed_students = {item[0] for name, item, error in failed}
+        if len(failed):
+            self.logger.error(f"{len(failed)} files of {len(failed_students)} students failed to sync")
+        return failed_students
+
+    def verify_files(self):
+        '''
+        reconciles the manifest with the files on disk, hashing any which changed or were never hashed, then removes
+        blobs no file links to any more
+
+        :return: dictionary of lists of local paths, by missing, changed, hashed and untracked
+        '''
+        report = self.manifest.verify()
+        for problem, local_paths in report.items():
+            for local_path in local_paths:
+                self.logger.info(f'{problem}: {local_path}')
+        self.logger.info(f'removed {self.blobs.prune()} unused blobs')
+        return report
 
     def get_files_and_forms(self):
         '''
@@ -361,58 +696,41 @@ class STEMWizardAPI(object):
         '''
         if not self.authenticated:
             self.authenticated = self.login()
-        data = {}
-        headers['X-CSRF-TOKEN'] = self.csrf
-        for category_id, category_title in tqdm(categories.items(), desc='Files and Forms'):
-            payload = {'page': 1,
-                       'per_page': 999,
-                       'st_stmile_id': 1337,
+
+        def fetch(category_id):
+            data = {}
+            payload = {'st_stmile_id': 1337,
                        'mileName': 'Files and Forms',
                        'division': 0,
                        'category_select': category_id,
                        'student_activation_status': 1,
                        }
             url = f'{self.url_base}/fairadmin/getstudentCustomMilestoneDetailView'
-            r = self.session.post(url, data=payload, headers=headers)
-            soup = BeautifulSoup(r.text, 'lxml')
-            head = soup.find('thead')
-            th_labels = []
-            for th in head.find_all('th'):
-                v = th.text.strip()
-                v = v.replace('2022 NCSEF ', '')
-                if 'Research' in v:
-                    v = 'Research Plan'
-                if len(v) <= 2:
-                    v = f"ISEF-{v.lower()}"
-                th_labels.append(v)
-
-            body = soup.find('tbody')
-            for row in body.find_all('tr'):
+            for th_labels, tds, row in self._iter_pages(url, payload, label=tables.files_and_forms_label):
                 import uuid
                 studentid = f"unknown_{uuid.uuid4()}"
                 studentdata = {'studentid': None, 'files': {}}
                 for header in th_labels[6:]:
                     studentdata['files'][header] = {'url': [], 'remote_filename': [], 'local_filename': [],
                                                     'local_lastmod': []}
-                for n, td in enumerate(row.find_all('td')):
+                for n, td in enumerate(tds):
                     if n < 5:
-                        studentdata[th_labels[n]] = td.text.strip().replace(" \n\n", ', ')
-                        a = td.find('a')
-                        if a:
-                            l = a['href']
+                        studentdata[th_labels[n]] = tables.cell_text(td).strip().replace(" \n\n", ', ')
+                        a = td.find('.//a')
+                        if a is not None:
+                            l = a.get('href')
                             atoms = l.split('/')
                             studentid = atoms[-2]
                             studentdata['studentid'] = studentid
                     else:
-                        a = td.find_all('a')
-                        if a:
-                            # studentdata['files'][th_labels[n]] = {'url': []}
-                            for link in a:
-                                atoms = link['href'].split('/')
-                                studentdata['files'][th_labels[n]]['url'].append(link['href'])
-                                studentdata['files'][th_labels[n]]['remote_filename'].append(atoms[-1])
+                        for link in td.iterfind('.//a'):
+                            atoms = link.get('href').split('/')
+                            studentdata['files'][th_labels[n]]['url'].append(link.get('href'))
+                            studentdata['files'][th_labels[n]]['remote_filename'].append(atoms[-1])
                 data[studentid] = studentdata
-        return data
+            return data
+
+        return self._fetch_by_category(fetch, desc='Files and Forms')
 
     def get_judges_materials(self):
         '''
@@ -422,51 +740,35 @@ class STEMWizardAPI(object):
         '''
         if not self.authenticated:
             self.authenticated = self.login()
-        data = {}
-        headers['X-CSRF-TOKEN'] = self.csrf
-        for category_id, category_title in tqdm(categories.items(), desc='judges materials'):
 
+        def fetch(category_id):
+            data = {}
             url = f'{self.url_base}/fairadmin/getstudentCustomMilestoneDetailView'
-            params = f'page=1&category_select={category_id}&per_page=999&st_stmile_id=3153&student_activation_status=1'
-            r = self.session.post(f"{url}?{params}", headers=headers)
-            soup = BeautifulSoup(r.text, 'lxml')
-            head = soup.find('thead')
-            th_labels = []
-            for th in head.find_all('th'):
-                hasp = th.find('p')
-                if hasp:
-                    v = th.find('p').text.strip()
-                else:
-                    v = th.text.strip()
-                v = v.replace('2022 NCSEF ', '')
-                for shortname in ['Research Paper', 'Abstract', 'Quad Chart', 'Lab Notebook ',
-                                  'Project Presentation Slides', '1 minute video', '1C', '7']:
-                    if shortname.lower() in v.lower():
-                        v = shortname
-                th_labels.append(v.strip())  # remove stray whitespace in th text
-            body = soup.find('tbody')
-            for row in body.find_all('tr'):
+            params = {'category_select': category_id, 'st_stmile_id': 3153, 'student_activation_status': 1}
+            for th_labels, tds, row in self._iter_pages(url, params, label=tables.milestone_label, in_query=True):
                 studentdata = {'studentid': None, 'files': {}}
                 for header in th_labels[5:]:
                     studentdata['files'][header] = {'url': [], 'remote_filename': [],
                                                     'local_filename': [], 'local_lastmod': []}
-                for n, td in enumerate(row.find_all('td')):
+                for n, td in enumerate(tds):
                     if n < 5:
-                        studentdata[th_labels[n]] = td.text.strip().replace(" \n\n", ', ')
-                        a = td.find('a')
-                        if a:
-                            l = a['href']
+                        studentdata[th_labels[n]] = tables.cell_text(td).strip().replace(" \n\n", ', ')
+                        a = td.find('.//a')
+                        if a is not None:
+                            l = a.get('href')
                             atoms = l.split('/')
                             studentid = atoms[-2]
                             studentdata['studentid'] = studentid
                     else:
-                        a = td.find('a')
-                        if a:
-                            studentdata['files'][th_labels[n]]['url'].append(a['href'])
+                        a = td.find('.//a')
+                        if a is not None:
+                            studentdata['files'][th_labels[n]]['url'].append(a.get('href'))
                         else:
-                            studentdata['files'][th_labels[n]]['remote_filename'].append(td.text)
+                            studentdata['files'][th_labels[n]]['remote_filename'].append(tables.cell_text(td))
                 data[studentid] = studentdata
-        return data
+            return data
+
+        return self._fetch_by_category(fetch, desc='judges materials')
 
     def get_project_info(self):
         '''
@@ -477,54 +779,39 @@ class STEMWizardAPI(object):
         if not self.authenticated:
             self.authenticated = self.login()
 
-        data = {}
-        headers['X-CSRF-TOKEN'] = self.csrf
-        for category_id, category_title in tqdm(categories.items(), desc='project'):
+        def fetch(category_id):
+            data = {}
+            category_title = categories[category_id]
             url = f'{self.url_base}/fairadmin/getstudentCustomMilestoneDetailView'
-            params = f'page=1&category_select={category_id}&child_fair_select=&searchhere=&orderby=&sortby=&division=&class_id=&per_page=999&student_completion_status=undefined&admin_status=undefined&student_checkin_status=&student_milestone_status=&st_stmile_id=1335&grade_select=&student_activation_status=1'
-            r = self.session.post(f"{url}?{params}", headers=headers)
-            fp = open(f'/tmp/project.html', 'w')
-            fp.write(r.text)
-            fp.close()
-            soup = BeautifulSoup(r.text, 'lxml')
-            head = soup.find('thead')
-            if head is None:
-                print(r.status_code)
-                print(r.text)
-                raise ValueError(
-                    f'no table head found on project tab for {category_title} of getstudentCustomMilestoneDetailView ')
-            th_labels = []
-            for th in head.find_all('th'):
-                hasp = th.find('p')
-                if hasp:
-                    v = th.find('p').text.strip()
-                else:
-                    v = th.text.strip()
-                v = v.replace('2022 NCSEF ', '')
-                for shortname in ['Research Paper', 'Abstract', 'Quad Chart', 'Lab Notebook ',
-                                  'Project Presentation Slides', '1 minute video', '1C', '7']:
-                    if shortname.lower() in v.lower():
-                        v = shortname
-                th_labels.append(v)
-            body = soup.find('tbody')
-            for row in body.find_all('tr'):
-                studentid = row['id'].replace('updatedStudentDiv_', '')
-                data[studentid] = {}
-                for n, td in enumerate(row.find_all('td')):
-                    divs = td.find_all('div')
-                    if divs and th_labels[n] != 'Project Name':
-                        data[studentid][th_labels[n]] = []
-                        for div in divs:
-                            data[studentid][th_labels[n]].append(div.text.strip())
-                    elif th_labels[n] == 'Project Name':
-                        p = td.find('p')
-                        if p:
-                            data[studentid][th_labels[n]] = p.text.strip()
+            params = {'category_select': category_id, 'child_fair_select': '', 'searchhere': '', 'orderby': '',
+                      'sortby': '', 'division': '', 'class_id': '', 'student_completion_status': 'undefined',
+                      'admin_status': 'undefined', 'student_checkin_status': '', 'student_milestone_status': '',
+                      'st_stmile_id': 1335, 'grade_select': '', 'student_activation_status': 1}
+            try:
+                for th_labels, tds, row in self._iter_pages(url, params, label=tables.milestone_label, in_query=True,
+                                                            require_head=True):
+                    studentid = row.get('id').replace('updatedStudentDiv_', '')
+                    data[studentid] = {}
+                    for n, td in enumerate(tds):
+                        divs = td.findall('.//div')
+                        if divs and th_labels[n] != 'Project Name':
+                            data[studentid][th_labels[n]] = []
+                            for div in divs:
+                                data[studentid][th_labels[n]].append(tables.cell_text(div).strip())
+                        elif th_labels[n] == 'Project Name':
+                            p = td.find('.//p')
+                            if p is not None:
+                                data[studentid][th_labels[n]] = tables.cell_text(p).strip()
+                            else:
+                                data[studentid][th_labels[n]] = tables.cell_text(td).strip()
                         else:
-                            data[studentid][th_labels[n]] = td.text.strip()
-                    else:
-                        data[studentid][th_labels[n]] = td.text.strip()
-        return data
+                            data[studentid][th_labels[n]] = tables.cell_text(td).strip()
+            except tables.MissingTableHead as e:
+                raise ValueError(
+                    f'no table head found on project tab for {category_title} of getstudentCustomMilestoneDetailView ') from e
+            return data
+
+        return self._fetch_by_category(fetch, desc='project')
 
     def download_student_reports(self, saved_report_id=972, report_title='Treasurer Report'):
         # wrapper for download_reports
@@ -536,6 +823,10 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--force", action='store_true', default=False, help="force data refresh")
+    parser.add_argument("--refresh", action='store_true', default=False,
+                        help="re-scrape the milestones, syncing only students whose rows changed")
+    parser.add_argument("--revalidate", action='store_true', default=False,
+                        help="re-download S3 files which students replaced, using conditional requests")
     parser.add_argument("--nostudent", action='store_true', help="refresh data on student files (default: %(default)s)")
     parser.add_argument("--nogoogle", action='store_true', help="sync to Google Drive (default: %(default)s)")
     parser.add_argument("--nodownload", action='store_true',
@@ -544,9 +835,25 @@ if __name__ == '__main__':
     parser.add_argument('--reports', default='all', const='all', nargs='?',
                         choices=['judge', 'student', 'treasurer', 'all', 'none'],
                         help='(default: %(default)s)')
+    parser.add_argument("--tree", nargs='?', const='/Automation', metavar='ROOT',
+                        help="print the Google Drive tree under ROOT (default: %(const)s) and exit")
+    parser.add_argument("--depth", type=int, default=None, help="levels below ROOT to print with --tree")
+    parser.add_argument("--verify", action='store_true', default=False,
+                        help="check the downloaded files against the manifest and exit")
 
     args = parser.parse_args()
 
+    if args.tree:
+        with STEMWizardAPI(configfile=args.config, login_stemwizard=False, login_google=True) as uut:
+            uut.googleapi.dump(args.tree, max_depth=args.depth)
+        raise SystemExit
+
+    if args.verify:
+        with STEMWizardAPI(configfile=args.config, login_stemwizard=False, login_google=False) as uut:
+            report = uut.verify_files()
+        print(', '.join(f'{len(local_paths)} {problem}' for problem, local_paths in report.items()))
+        raise SystemExit
+
     print("logging into STEMWizard")
     uut = STEMWizardAPI(configfile=args.config, login_stemwizard=True, login_google=True)
 
@@ -563,4 +870,6 @@ if __name__ == '__main__':
 
     if not args.nostudent:
         print('analyzing student files')
-        student_data = uut.studentSync()
+        student_data = uut.studentSync(refresh=args.refresh, revalidate=args.revalidate)
+
+    uut.close()
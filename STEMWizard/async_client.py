@@ -0,0 +1,306 @@
+import asyncio
+import os
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+import requests
+from requests.cookies import create_cookie, get_cookie_header
+from requests.structures import CaseInsensitiveDict
+
+from http_cache import LOGIN_PATH
+from logstuff import get_logger
+
+logger = get_logger('async_client')
+
+REDIRECTS = [301, 302, 303, 307, 308]
+EXPIRED = [401, 419]  # 419 is Laravel's answer to a stale CSRF token
+
+
+class IncompleteDownload(aiohttp.ClientPayloadError):
+    '''the connection ended before the whole file arrived'''
+
+
+def _form(fields):
+    '''aiohttp only encodes strings, STEM Wizard payloads mix in ints.  None values are left out, as requests does'''
+    if fields is None or isinstance(fields, (str, bytes)):
+        return fields
+    return {k: str(v) for k, v in fields.items() if v is not None}
+
+
+class AsyncClient(object):
+    '''
+    one asyncio event loop, on its own thread, doing the STEM Wizard and S3 I/O for every caller.  Requests to a host
+    wait on that host's semaphore, so however many threads submit work the number in flight per host stays bounded.
+
+    Cookies live in the requests cookie jar shared with the SessionPool, so a login through either is seen by both,
+    and cacheable endpoints go through the same ResponseCache.  Synchronous code calls run(), or submit() to get a
+    concurrent.futures.Future it can wait on later.
+
+    When STEM Wizard answers 401 or 419, or sends a request to the login page, the reauthenticate callable is run
+    once, however many requests noticed, and the requests retried with the CSRF header and _token it returns.
+    '''
+
+    def __init__(self, cache, cookies, host_limits=None, default_limit=4, chunk_size=512 * 1024):
+        '''
+        :param cache: http_cache.ResponseCache
+        :param cookies: requests cookie jar, shared with the synchronous sessions
+        :param host_limits: dictionary of concurrent requests allowed by host name suffix
+        :param default_limit: concurrent requests allowed for hosts not in host_limits
+        :param chunk_size: bytes read at a time when streaming downloads to disk
+        '''
+        self.cache = cache
+        self.cookies = cookies
+        self.host_limits = host_limits or {}
+        self.default_limit = default_limit
+        self.chunk_size = chunk_size
+        self.slots = {}
+        self.http = None
+        self.reauthenticate = None  # callable logging in again, returning (csrf, token)
+        self.credentials = None
+        self.generation = 0  # logins so far, so requests which failed together log in once
+        self.login_lock = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async_client', daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine):
+        '''
+        schedule a coroutine on the client's loop
+
+        :return: concurrent.futures.Future of its result
+        '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        '''
+        run a coroutine on the client's loop and wait for its result, the synchronous methods are wrappers of this
+        '''
+        return self.submit(coroutine).result()
+
+    def _slot(self, url):
+        host = urlsplit(url).hostname or ''
+        if host not in self.slots:
+            limit = self.default_limit
+            for suffix, host_limit in self.host_limits.items():
+                if host.endswith(suffix):
+                    limit = host_limit
+                    break
+            self.slots[host] = asyncio.Semaphore(limit)
+        return self.slots[host]
+
+    def _session(self):
+        if self.http is None:
+            # cookies are handled against the shared jar, per hop, so aiohttp must not keep its own
+            self.http = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar(),
+                                              timeout=aiohttp.ClientTimeout(total=None, sock_read=300))
+        return self.http
+
+    def _save_cookies(self, resp):
+        host = resp.url.host
+        for name, morsel in resp.cookies.items():
+            self.cookies.set_cookie(create_cookie(name, morsel.value, domain=morsel['domain'] or host,
+                                                  path=morsel['path'] or '/', secure=bool(morsel['secure'])))
+
+    @staticmethod
+    def _response(resp, body):
+        r = requests.Response()
+        r.status_code = resp.status
+        r.reason = resp.reason
+        r.headers = CaseInsensitiveDict(resp.headers)
+        r.url = str(resp.url)
+        r._content = body
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        return r
+
+    async def _open(self, method, url, params=None, data=None, headers=None, allow_redirects=True):
+        '''
+        send a request, following redirects by hand so cookies set along the way (as on login) reach the shared jar
+
+        :return: open aiohttp response, caller must release it
+        '''
+        headers = dict(headers or {})
+        params, data = _form(params), _form(data)
+        for hop in range(10):
+            cookie = get_cookie_header(self.cookies, requests.Request(method, url).prepare())
+            if cookie:
+                headers['Cookie'] = cookie
+            else:
+                headers.pop('Cookie', None)
+            resp = await self._session().request(method, url, params=params, data=data, headers=headers,
+                                                 allow_redirects=False)
+            self._save_cookies(resp)
+            if not allow_redirects or resp.status not in REDIRECTS or 'Location' not in resp.headers:
+                return resp
+            url = urljoin(str(resp.url), resp.headers['Location'])
+            resp.release()
+            params = None
+            if resp.status in [301, 302, 303]:
+                method, data = 'GET', None
+        raise aiohttp.TooManyRedirects(resp.request_info, resp.history)
+
+    @staticmethod
+    def _expired(resp, url):
+        if resp.status in EXPIRED:
+            return True
+        if LOGIN_PATH in url:
+            return False
+        if resp.status in REDIRECTS and LOGIN_PATH in resp.headers.get('Location', ''):
+            return True
+        return LOGIN_PATH in resp.url.path
+
+    async def _login_again(self, generation, headers, data):
+        '''
+        log in again unless another request already did since this one was sent
+
+        :return: headers and data updated with the new CSRF token and _token
+        '''
+        if self.login_lock is None:
+            self.login_lock = asyncio.Lock()
+        async with self.login_lock:
+            if self.generation == generation:
+                logger.info('STEM Wizard session expired, logging in again')
+                # login is synchronous code which runs its requests on this loop, so it has to wait elsewhere
+                self.credentials = await self.loop.run_in_executor(None, self.reauthenticate)
+                self.generation += 1
+        csrf, token = self.credentials
+        headers = dict(headers or {})
+        if 'X-CSRF-TOKEN' in headers:
+            headers['X-CSRF-TOKEN'] = csrf
+        if isinstance(data, dict) and '_token' in data:
+            data = dict(data, _token=token)
+        return headers, data
+
+    async def request(self, method, url, params=None, data=None, headers=None, allow_redirects=True,
+                      reauthenticate=True):
+        '''
+        fetch a whole response, from the cache when the endpoint is cached and the entry is fresh or not modified
+
+        :param reauthenticate: log in again and retry once if the session has expired, False for login's own requests
+        :return: requests.Response with the body read
+        '''
+        ttl = self.cache.ttl(url) if method.upper() in ['GET', 'POST'] else None
+        key = row = None
+        if ttl is not None:
+            key = self.cache.key(method, url, params, data)
+            row = self.cache.load(key)
+            if row is not None:
+                if time.time() - row[4] < ttl:
+                    logger.debug(f"serving {url} from cache")
+                    return self.cache.response(row)
+                headers = dict(headers or {}, **self.cache.validators(row))
+
+        generation = self.generation
+        async with self._slot(url):
+            resp = await self._open(method, url, params=params, data=data, headers=headers,
+                                    allow_redirects=allow_redirects)
+            try:
+                body = await resp.read()
+            finally:
+                resp.release()
+        if reauthenticate and self.reauthenticate is not None and self._expired(resp, url):
+            headers, data = await self._login_again(generation, headers, data)
+            return await self.request(method, url, params=params, data=data, headers=headers,
+                                      allow_redirects=allow_redirects, reauthenticate=False)
+        if row is not None and resp.status == 304:
+            logger.debug(f"{url} not modified, serving from cache")
+            self.cache.touch(key)
+            return self.cache.response(row)
+        r = self._response(resp, body)
+        if key is not None and r.status_code == 200:
+            self.cache.store(key, r, url)
+        return r
+
+    @staticmethod
+    def _range_start(resp):
+        ''' first byte of a 206 response's Content-Range, None if it doesn't say '''
+        start = resp.headers.get('Content-Range', '').partition(' ')[2].partition('-')[0]
+        return int(start) if start.isdigit() else None
+
+    @staticmethod
+    def _expected_size(resp):
+        ''' total bytes the finished file should have, None if the response doesn't say '''
+        if 'Content-Encoding' in resp.headers:
+            return None  # the length is of the encoded body, not what reaches the file
+        if resp.status == 206:
+            total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        return resp.content_length
+
+    async def download(self, method, url, filename, data=None, headers=None, reauthenticate=True):
+        '''
+        stream a response body to filename.part, renamed over filename once its length matches Content-Length, so an
+        interrupted download never looks like a finished file.  A GET with a .part left from an earlier attempt asks
+        for just the rest with Range, guarded by If-Range so a changed object starts over.  Nothing is written for
+        error statuses or html (login or error) pages.
+
+        :param reauthenticate: log in again and retry once if the session has expired
+        :return: requests.Response with status and headers but no body
+        :raises IncompleteDownload: fewer bytes arrived than promised, the .part is kept to resume from
+        '''
+        part = f'{filename}.part'
+        validator_file = f'{part}.validator'
+        request_headers = dict(headers or {})
+        if method.upper() == 'GET' and os.path.exists(part) and os.path.exists(validator_file):
+            with open(validator_file, 'r') as f:
+                validator = f.read()
+            offset = os.path.getsize(part)
+            if offset and validator:
+                # finish the file first, conditions on the whole object apply to the next refresh
+                request_headers.pop('If-None-Match', None)
+                request_headers.pop('If-Modified-Since', None)
+                request_headers['Range'] = f'bytes={offset}-'
+                request_headers['If-Range'] = validator
+
+        generation = self.generation
+        async with self._slot(url):
+            resp = await self._open(method, url, data=data, headers=request_headers)
+            try:
+                expired = reauthenticate and self.reauthenticate is not None and self._expired(resp, url)
+                if resp.status == 416:
+                    # the .part doesn't fit the object any more, start again from nothing
+                    for stale in [part, validator_file]:
+                        if os.path.exists(stale):
+                            os.remove(stale)
+                    raise IncompleteDownload(f'{url} range not satisfiable, restarting')
+                if not expired and resp.status < 300 and resp.headers.get('Content-Type') != 'text/html':
+                    if resp.status == 206:
+                        start = self._range_start(resp)
+                        if start != os.path.getsize(part):
+                            # not the rest of what's in the .part, appending it would corrupt the file
+                            for stale in [part, validator_file]:
+                                if os.path.exists(stale):
+                                    os.remove(stale)
+                            raise IncompleteDownload(f'{url} sent a range from {start}, not from the end of the '
+                                                     f'.part, restarting')
+                        logger.debug(f'resuming {filename} at {start} bytes')
+                        mode = 'ab'
+                    else:
+                        mode = 'wb'
+                        validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified') or ''
+                        with open(validator_file, 'w') as f:
+                            f.write(validator)
+                    loop = asyncio.get_running_loop()
+                    with open(part, mode) as f:
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            # a write can block on a slow disk, don't hold up every other request on the loop
+                            await loop.run_in_executor(None, f.write, chunk)
+                    expected = self._expected_size(resp)
+                    received = os.path.getsize(part)
+                    if expected is not None and received != expected:
+                        raise IncompleteDownload(f'{url} ended at {received} of {expected} bytes')
+                    os.replace(part, filename)
+                    os.remove(validator_file)
+            finally:
+                resp.release()
+        if expired:
+            headers, data = await self._login_again(generation, headers, data)
+            return await self.download(method, url, filename, data=data, headers=headers, reauthenticate=False)
+        return self._response(resp, b'')
+
+    def close(self):
+        if self.http is not None:
+            self.run(self.http.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
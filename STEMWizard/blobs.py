@@ -0,0 +1,76 @@
+import os
+
+from logstuff import get_logger
+
+logger = get_logger('blobs')
+
+
+class BlobStore(object):
+    '''
+    content addressed store of downloaded files, one file per md5 under root.  The div/cat/project layout the rest of
+    the code works with is made of hardlinks into it, so the same upload reached through several milestones or team
+    members takes the disk space of one.  Nothing writes into a layout file in place (downloads are renamed over it),
+    so a blob keeps matching its name.
+    '''
+
+    def __init__(self, root='files/blobs'):
+        '''
+        :param root: directory for the blobs, on the same filesystem as the layout so they can be hardlinked
+        '''
+        self.root = root
+
+    def path(self, md5):
+        return f'{self.root}/{md5[:2]}/{md5}'
+
+    def adopt(self, path, md5):
+        '''
+        make a layout file a link to the blob of its content, storing the blob if this is the first copy
+
+        :param path: layout file, already hashed
+        :param md5: its hex digest
+        :return: True if the content was already stored and path now shares it
+        '''
+        blob = self.path(md5)
+        try:
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(path, blob)
+                    return False
+                except FileExistsError:
+                    pass  # another worker stored the same content first, share theirs
+            if os.path.samefile(path, blob):
+                return False
+            # link beside the file and rename over it, the path is never missing
+            temporary = f'{path}.link'
+            os.link(blob, temporary)
+            os.replace(temporary, path)
+            logger.debug(f'{path} duplicates {md5}, now linked to it')
+            return True
+        except OSError as e:
+            # no hardlinks on this filesystem, the file stays a plain copy
+            logger.warning(f'could not link {path} into {self.root}: {e}')
+            return False
+
+    def forget(self, path, md5):
+        '''
+        drop the blob a layout file was linked to once the file's content no longer matches it
+        '''
+        blob = self.path(md5)
+        if os.path.exists(blob) and os.path.exists(path) and os.path.samefile(path, blob):
+            os.remove(blob)
+
+    def prune(self):
+        '''
+        remove blobs no layout file links to any more, left behind when a file was downloaded again
+
+        :return: number of blobs removed
+        '''
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                blob = os.path.join(dirpath, filename)
+                if os.stat(blob).st_nlink == 1:
+                    os.remove(blob)
+                    removed += 1
+        return removed
@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+from tqdm import tqdm
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class DownloadManager(object):
+    '''
+    downloads many files at once on the STEMWizardAPI's async client.  S3 objects and STEM Wizard fileDownload posts
+    each have their own concurrency limit, transient failures (connection errors, 429 and 5xx) are retried with
+    exponential backoff, and totals are kept for a summary at the end.
+
+    Jobs are either queued with add() and run together by run(), or downloaded one at a time with fetch() from
+    any number of threads, within the same limits.
+    '''
+
+    def __init__(self, api, s3_workers=6, stemwizard_workers=2, retries=3, backoff=1.0):
+        '''
+        :param api: STEMWizardAPI, authenticated with its CSRF token gathered
+        :param s3_workers: concurrent S3 downloads
+        :param stemwizard_workers: concurrent STEM Wizard downloads
+        :param retries: attempts after the first for a transient failure
+        :param backoff: seconds before the first retry, doubling for each one after
+        '''
+        self.api = api
+        self.limits = {'s3': s3_workers, 'stemwizard': stemwizard_workers}
+        self.retries = retries
+        self.backoff = backoff
+        self.jobs = []
+        self.slots = None
+        self.downloaded = []
+        self.unchanged = []
+        self.failed = []
+        self.bytes = 0
+        self.seconds = 0  # time with at least one download in progress
+        self.active = 0
+        self.busy_since = None
+
+    def s3_job(self, url, local_filename, project, filetype, conditional=False):
+        '''
+        :param project: project number, for the manifest
+        :param filetype: file type, for the manifest
+        :param conditional: only fetch the object if it changed since it was last downloaded
+        :return: job for add() or fetch()
+        '''
+        headers = self.api._s3_validator_headers(local_filename) if conditional else None
+        return ('s3', local_filename, project, filetype, url, 'GET', url, None, headers)
+
+    def stemwizard_job(self, remote_filename, local_filename, project, filetype, referer='FilesAndForms'):
+        url, payload, headers = self.api._stemwizard_download_request(remote_filename, referer)
+        return ('stemwizard', local_filename, project, filetype, remote_filename, 'POST', url, payload, headers)
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def _slots(self):
+        if self.slots is None:
+            self.slots = {kind: asyncio.Semaphore(limit) for kind, limit in self.limits.items()}
+        return self.slots
+
+    async def _download(self, job, progress=None):
+        '''
+        :return: 'downloaded', 'unchanged' or 'failed'
+        '''
+        # only ever touched on the loop's thread, no lock needed
+        if self.active == 0:
+            self.busy_since = time.time()
+        self.active += 1
+        try:
+            return await self._attempts(job, progress)
+        finally:
+            self.active -= 1
+            if self.active == 0:
+                self.seconds += time.time() - self.busy_since
+
+    async def _attempts(self, job, progress=None):
+        kind, local_filename, project, filetype, source, method, url, data, headers = job
+        path = self.api._local_file_path(local_filename)
+        async with self._slots()[kind]:
+            for attempt in range(self.retries + 1):
+                try:
+                    r = await self.api.aio.download(method, url, path, data=data, headers=headers)
+                    if r.status_code not in RETRY_STATUS:
+                        break
+                    problem = f'status code {r.status_code}'
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    r = None
+                    problem = repr(e)
+                if attempt < self.retries:
+                    delay = self.backoff * 2 ** attempt * (1 + random.random())
+                    self.api.logger.warning(f'{problem} downloading {local_filename}, retrying in {delay:.1f}s')
+                    await asyncio.sleep(delay)
+        if progress is not None:
+            progress.update()
+        if r is not None and r.status_code == 304:
+            self.unchanged.append(local_filename)
+            return 'unchanged'
+        elif r is None or r.status_code >= 300:
+            self.failed.append((local_filename, problem if r is None else f'status code {r.status_code}'))
+            self.api.logger.error(f'failed to download {local_filename} from {url}: {self.failed[-1][1]}')
+            return 'failed'
+        elif r.headers.get('Content-Type') == 'text/html':
+            self.failed.append((local_filename, 'html page in place of the file'))
+            self.api.logger.error(f'failed to download {local_filename}, got an html page')
+            return 'failed'
+        else:
+            validators = r.headers if kind == 's3' else {}
+            # hashing a large file would stall every other download on the loop
+            entry = await asyncio.get_running_loop().run_in_executor(
+                None, self.api.manifest.record, local_filename, project, filetype, source, validators.get('ETag'),
+                validators.get('Last-Modified'))
+            self.downloaded.append(local_filename)
+            self.bytes += entry['size']
+            self.api.logger.info(f'downloaded {local_filename}')
+            return 'downloaded'
+
+    async def _run(self, desc):
+        with tqdm(total=len(self.jobs), desc=desc) as progress:
+            await asyncio.gather(*[self._download(job, progress) for job in self.jobs])
+
+    def fetch(self, job):
+        '''
+        download one job now, blocking the calling thread until it has succeeded or run out of retries
+
+        :return: 'downloaded', 'unchanged' or 'failed'
+        '''
+        return self.api.aio.run(self._download(job))
+
+    def run(self, desc='downloads'):
+        '''
+        downloads everything added, returning when all of it has succeeded or run out of retries
+
+        :param desc: progress bar label
+        :return: list of (local filename, reason) for the downloads which failed
+        '''
+        self.api.aio.run(self._run(desc))
+        self.jobs = []
+        return self.failed
+
+    def summary(self):
+        rate = self.bytes / self.seconds / 1024 / 1024 if self.seconds else 0
+        return (f'downloaded {len(self.downloaded)} files, {self.bytes / 1024 / 1024:.1f} MB in {self.seconds:.0f}s '
+                f'({rate:.1f} MB/s), {len(self.unchanged)} unchanged, {len(self.failed)} failed')
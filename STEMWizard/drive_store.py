@@ -0,0 +1,124 @@
+import json
+import sqlite3
+
+from logstuff import get_logger
+
+logger = get_logger('drive_store')
+
+
+class DirtyDict(dict):
+    '''dictionary which remembers which keys were set since the last flush'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+
+class DriveStore(object):
+    '''
+    SQLite backed cache of Google Drive metadata, one row per file so single changes are cheap upserts rather than
+    a rewrite of everything, and each flush is a single atomic transaction
+    '''
+    FIELDS = ['title', 'parents', 'mimeType', 'modifiedDate', 'md5Checksum', 'fullpath']
+
+    def __init__(self, filename='caches/GoogleDriveCache.sqlite'):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, check_same_thread=False)  # callers serialize access with their own lock
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS files (id TEXT PRIMARY KEY, title TEXT, parents TEXT,
+                               mimeType TEXT, modifiedDate TEXT, md5Checksum TEXT, fullpath TEXT)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_fullpath ON files (fullpath)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS uploads (remotepath TEXT PRIMARY KEY, session TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS local_md5 (path TEXT PRIMARY KEY, size INTEGER, '
+                            'mtime REAL, md5 TEXT)')
+
+    @staticmethod
+    def slim(fileinfo):
+        '''
+        reduce a Drive file resource to the fields this package uses
+
+        :param fileinfo: file resource (dict or pydrive2 GoogleDriveFile) from the Drive API
+        :return: dictionary with id, the stored FIELDS and an empty children list
+        '''
+        node = {'id': fileinfo['id'], 'children': [], 'fullpath': fileinfo.get('fullpath', '')}
+        node['title'] = fileinfo['title']
+        node['parents'] = [{'id': parent['id']} for parent in fileinfo.get('parents', [])]
+        node['mimeType'] = fileinfo['mimeType']
+        node['modifiedDate'] = fileinfo.get('modifiedDate', '1970-01-01T00:00:00.000Z')
+        node['md5Checksum'] = fileinfo.get('md5Checksum')
+        return node
+
+    def load_files(self):
+        '''
+        :return: dictionary of slimmed file nodes by id, children filled in from parents
+        '''
+        ids = {}
+        for row in self.db.execute(f"SELECT id, {', '.join(DriveStore.FIELDS)} FROM files"):
+            id, title, parents, mimeType, modifiedDate, md5Checksum, fullpath = row
+            ids[id] = {'id': id, 'title': title, 'parents': [{'id': p} for p in json.loads(parents)],
+                       'mimeType': mimeType, 'modifiedDate': modifiedDate, 'md5Checksum': md5Checksum,
+                       'fullpath': fullpath, 'children': []}
+        for id, node in ids.items():
+            for parent in node['parents']:
+                if parent['id'] in ids:
+                    ids[parent['id']]['children'].append(id)
+        logger.debug(f'loaded {len(ids)} files from {self.filename}')
+        return ids
+
+    def load_meta(self):
+        return {key: json.loads(value) for key, value in self.db.execute('SELECT key, value FROM meta')}
+
+    def load_uploads(self):
+        return {remotepath: json.loads(session)
+                for remotepath, session in self.db.execute('SELECT remotepath, session FROM uploads')}
+
+    def load_local_md5(self):
+        hashes = DirtyDict()
+        for path, size, mtime, md5 in self.db.execute('SELECT path, size, mtime, md5 FROM local_md5'):
+            dict.__setitem__(hashes, path, {'size': size, 'mtime': mtime, 'md5': md5})
+        return hashes
+
+    def _row(self, node):
+        return (node['id'], node['title'], json.dumps([p['id'] for p in node['parents']]), node['mimeType'],
+                node['modifiedDate'], node.get('md5Checksum'), node['fullpath'])
+
+    def flush(self, ids, dirty, deleted, meta, uploads, local_md5, replace_all=False):
+        '''
+        write pending changes in a single transaction
+
+        :param ids: dictionary of file nodes by id
+        :param dirty: ids of nodes to upsert
+        :param deleted: ids of nodes to delete
+        :param meta: dictionary of small values (change token, timestamps) to save
+        :param uploads: resumable upload sessions in progress, replaces what was stored
+        :param local_md5: DirtyDict of local file hashes, only dirty keys are written
+        :param replace_all: discard every stored file row first, for a full listing
+        :return: nothing
+        '''
+        md5_paths = list(local_md5.dirty)  # hashes set after this are written next time
+        with self.db:
+            if replace_all:
+                self.db.execute('DELETE FROM files')
+                dirty = ids.keys()
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                [self._row(ids[id]) for id in dirty if id in ids])
+            self.db.executemany('DELETE FROM files WHERE id = ?', [(id,) for id in deleted])
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                [(key, json.dumps(value)) for key, value in meta.items()])
+            self.db.execute('DELETE FROM uploads')
+            self.db.executemany('INSERT INTO uploads VALUES (?, ?)',
+                                [(remotepath, json.dumps(session)) for remotepath, session in uploads.items()])
+            self.db.executemany('INSERT OR REPLACE INTO local_md5 VALUES (?, ?, ?, ?)',
+                                [(path, local_md5[path]['size'], local_md5[path]['mtime'], local_md5[path]['md5'])
+                                 for path in md5_paths])
+        local_md5.dirty.difference_update(md5_paths)
+
+    def close(self):
+        self.db.close()
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import time
@@ -50,3 +51,28 @@ def read_json_cache(cache_filename, max_cache_age=600):
         logger.error(e)
         cache = {}
     return cache
+
+
+def file_md5(path, hash_cache=None):
+    '''
+    MD5 hex digest of a local file, in the same form as Drive's md5Checksum
+
+    :param path: local filename
+    :param hash_cache: optional dictionary of previously computed digests, keyed by path and invalidated when the
+                       file's size or mtime changes; updated in place
+    :return: hex digest
+    '''
+    st = os.stat(path)
+    if hash_cache is not None:
+        cached = hash_cache.get(path)
+        if cached is not None and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime:
+            return cached['md5']
+    md5 = hashlib.md5()
+    fp = open(path, 'rb')
+    for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+        md5.update(chunk)
+    fp.close()
+    digest = md5.hexdigest()
+    if hash_cache is not None:
+        hash_cache[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'md5': digest}
+    return digest
@@ -1,7 +1,7 @@
 import olefile
 import pandas as pd
 
-from utils import headers
+from utils import ACCEPT_HTML
 
 
 def export_list(self, listname):
@@ -92,7 +92,7 @@ def export_list(self, listname):
     payload.update(payload_specific)
 
     self.logger.debug(f'posting to {url} using {listname} params')
-    rf = self.session.post(url, data=payload, headers=headers, stream=True)
+    rf = self.session.post(url, data=payload, headers=self._headers(), stream=True)
     if rf.status_code >= 300:
         self.logger.error(f"status code {rf.status_code} on post to {url}")
         return
@@ -137,9 +137,7 @@ def export_report(self, saved_report_id, user_type, report_title):
 
     url = f'{self.url_base}/fairadmin/generateReport'
 
-    headers['Referer'] = 'https://ncsef.stemwizard.com/fairadmin/report'
-    headers[
-        'Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9'
+    headers = self._headers(referer='https://ncsef.stemwizard.com/fairadmin/report', accept=ACCEPT_HTML)
     self.logger.debug(f'posting to {url} using {saved_report_id} report id')
     rf = self.session.post(url, data=payload, headers=headers, stream=True)
     if rf.status_code >= 300:
@@ -203,22 +201,60 @@ def _patch_team_filepaths(self, data):
     return data
 
 
-def download_file_from_url_via_get(self, url, local_filename):
+def _s3_validator_headers(self, local_filename):
+    '''
+    :return: If-None-Match/If-Modified-Since for an S3 object already downloaded to local_filename, empty if the
+             manifest has no record of it
+    '''
+    entry = self.manifest.get(local_filename)
+    if entry is None:
+        return {}
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def download_file_from_url_via_get(self, url, local_filename, conditional=False, project=None, filetype=None):
     '''
     streams a specified URL to a local filename, generic get of binary file
 
     :param url: the url
     :param local_filename: the filename to write the streamed file to
+    :param conditional: only fetch the file if it changed since it was last downloaded, which costs a 304 if it didn't
+    :param project: project number, for the manifest
+    :param filetype: file type, for the manifest
     :return:
     '''
     self.logger.info(f"DownloadFileFromS3Bucket: downloading {url} to {local_filename} from S3")
-    r = self.session.get(url)
-
-    if r.status_code >= 300:
+    headers = self._s3_validator_headers(local_filename) if conditional else None
+    r = self._download_to_local_file_path(local_filename, 'GET', url, headers=headers)
+    if r.status_code == 304:
+        self.logger.info(f"{local_filename} is unchanged on S3")
+    elif r.status_code >= 300:
         self.logger.error(f"status code {r.status_code} on post to {url}")
-        return
+    elif r.headers.get('Content-Type') != 'text/html':
+        self.manifest.record(local_filename, project, filetype, url, etag=r.headers.get('ETag'),
+                             last_modified=r.headers.get('Last-Modified'))
 
-    return self._download_to_local_file_path(local_filename, r)
+
+def _stemwizard_download_request(self, filename_remote, referer='FilesAndForms'):
+    '''
+    the fileDownload request for a file held by STEM Wizard, the CSRF token must already be on the object
+
+    :param filename_remote: filename in the STEMWizard system
+    :param referer: STEMWizard page the request comes from
+    :return: url, form data and headers
+    '''
+    headers = self._headers(referer=f'{self.url_base}f/fairadmin/{referer}', csrf=True)
+    url = f'{self.url_base}/fairadmin/fileDownload'
+    payload = {'_token': self.token,
+               'download_filen_path': '/EBS-Stem/stemwizard/webroot/stemwizard/public/assets/images/milestone_uploads',
+               'download_hideData': filename_remote,
+               }
+    return url, payload, headers
 
 
 def download_from_stemwizard_via_post(self, filename_remote, local_file_path, referer='FilesAndForms'):
@@ -230,17 +266,7 @@ def download_from_stemwizard_via_post(self, filename_remote, local_file_path, re
     :return:
     '''
     self.get_csrf_token()
-    headers['X-CSRF-TOKEN'] = self.csrf
-    headers['Referer'] = f'{self.url_base}f/fairadmin/{referer}'
-    url = f'{self.url_base}/fairadmin/fileDownload'
-
-    payload = {'_token': self.token,
-               'download_filen_path': '/EBS-Stem/stemwizard/webroot/stemwizard/public/assets/images/milestone_uploads',
-               'download_hideData': filename_remote,
-               }
-
-    rf = self.session.post(url, data=payload, headers=headers)
+    url, payload, headers = self._stemwizard_download_request(filename_remote, referer)
+    rf = self._download_to_local_file_path(local_file_path, 'POST', url, data=payload, headers=headers)
     if rf.status_code >= 300:
         self.logger.error(f"status code {rf.status_code} on post to {url}")
-        return
-    return self._download_to_local_file_path(local_file_path, rf)
@@ -1,14 +1,24 @@
 import json
 import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
-from pprint import pprint
+from functools import partial
 
 import pytz
 from dateutil import parser
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
 from pydrive2.auth import GoogleAuth, ServiceAccountCredentials
 from pydrive2.drive import GoogleDrive
+from pydrive2.files import ApiRequestError
 from tqdm import tqdm
 
+from drive_store import DriveStore
+from fileutils import file_md5
 from logstuff import get_logger
 
 
@@ -37,34 +47,87 @@ class NCSEFGoogleDrive(object):
                          'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
 
                          }
-
-    def __init__(self, cache_file_name='caches/GoogleDriveCache.json'):
-        ''' instantiate object'''
+    RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'backendError']
+    # only ask Drive for what DriveStore keeps
+    FILE_FIELDS = 'id,title,parents(id),mimeType,modifiedDate,md5Checksum'
+    PARENT_BATCH_SIZE = 40  # parent ids per "in parents" query, keeps the query string well under Drive's limit
+
+    def __init__(self, cache_file_name='caches/GoogleDriveCache.sqlite', max_requests_per_second=8,
+                 resumable_threshold=32 * 1024 * 1024, chunk_size=8 * 1024 * 1024, root=None):
+        '''
+        instantiate object
+
+        :param root: fullpath of the only folder to list (e.g. /Automation), None lists everything visible
+        '''
+        self.root = root.rstrip('/') if root else None
+        if chunk_size % (256 * 1024) != 0:
+            raise ValueError(f'chunk_size {chunk_size} must be a multiple of 256KB for Drive resumable uploads')
+        self.resumable_threshold = resumable_threshold  # files at least this large are uploaded in chunks
+        self.chunk_size = chunk_size
         self.logger = get_logger('google')
         self.cache_file_name = cache_file_name
+        self.store = DriveStore(cache_file_name)
+        self.local_md5 = self.store.load_local_md5()
         self.drive = self._auth()
+        self.lock = threading.RLock()  # guards ids, the index and cache writes when uploading concurrently
+        self.folder_lock = threading.RLock()  # one folder creator at a time, so two threads don't make the same one
+        self._local = threading.local()  # httplib2 isn't thread safe, each worker gets its own
+        self._throttle_lock = threading.Lock()
+        self.min_request_interval = 1.0 / max_requests_per_second
+        self._next_request_at = 0
         self.ids = None
+        self._dirty = set()  # ids changed since the last cache write
+        self._deleted = set()  # ids removed since the last cache write
+        self._replace_all = False  # next cache write replaces every file row
+        self.paths = {}  # fullpath -> id
+        self.parent_ids = {}  # id -> parent id
+        self.change_token = None
+        self.uploads = {}  # remotepath -> resumable upload session in progress
         self.last_updated = None
         self.last_checked = None
+        self.last_full = None
         self.list_all(force=False)
 
     def __str__(self, indent_character=' ', show_emoji=True, root=None):
         '''output object as a string'''
-        indent = 0
-        response = ""
-        for id, node in self.ids.items():
-            if node['labels']['trashed']:
-                continue  # ignore trash, we shouldn't be working with it from the API anyway
-            elif root is not None:
-                if node['fullpath'] == root:
-                    response += self._node_output(node, root=root, indent_character=indent_character,
-                                                  show_emoji=show_emoji)
-            elif len(node['parents']) == 0:
-                response += self._node_output(node)
-        return response
-
-    def dump(self, root, indent_character=' ', show_emoji=True, ):
-        return (self.__str__(root=root, indent_character=indent_character, show_emoji=show_emoji))
+        return ''.join(f"{line}\n" for line in self.walk(root=root, indent_character=indent_character,
+                                                         show_emoji=show_emoji))
+
+    def dump(self, root, indent_character=' ', show_emoji=True, max_depth=None, mimetypes=None, fp=None):
+        '''write the tree under root to fp (stdout by default) a line at a time, see walk for the parameters'''
+        fp = fp or sys.stdout
+        for line in self.walk(root=root, indent_character=indent_character, show_emoji=show_emoji,
+                              max_depth=max_depth, mimetypes=mimetypes):
+            fp.write(f"{line}\n")
+
+    def walk(self, root=None, indent_character=' ', show_emoji=True, max_depth=None, mimetypes=None):
+        '''
+        generate one line per node of the tree, depth first with children sorted by title.  Iterative, so deep
+        trees don't run into the recursion limit, and nothing is held beyond the current path.
+
+        :param root: fullpath to start from, None for every top level node
+        :param indent_character: repeated once per level of depth
+        :param show_emoji: prefix each line with an emoji for its type
+        :param max_depth: levels below root to descend, None for no limit
+        :param mimetypes: only output nodes whose mimeType contains one of these (e.g. ['folder', 'pdf']), folders
+                          are still descended into
+        :return: generator of lines, without newlines
+        '''
+        if root is None:
+            starts = [id for id, node in self.ids.items() if self.parent_ids.get(id) not in self.ids]
+        else:
+            starts = [self._lookup(root)] if self._lookup(root) else []
+        stack = [(id, 0) for id in sorted(starts, key=lambda id: self.ids[id]['title'], reverse=True)]
+        while stack:
+            id, depth = stack.pop()
+            node = self.ids[id]
+            if mimetypes is None or any(m in node['mimeType'] for m in mimetypes):
+                emoji = self._emoji(node) if show_emoji else ''
+                yield f"{indent_character * depth}{emoji}{node['fullpath']}"
+            if max_depth is None or depth < max_depth:
+                children = [child for child in set(node['children']) if child in self.ids]
+                children.sort(key=lambda child: self.ids[child]['title'], reverse=True)
+                stack.extend((child, depth + 1) for child in children)
 
     def _auth(self):
         ''' authenticate with Google Drive API '''
@@ -74,122 +137,424 @@ class NCSEFGoogleDrive(object):
         drive = GoogleDrive(gauth)
         return drive
 
-    def _node_output(self, node, indent=0, indent_character=" ", show_emoji=True, root=None):
-        response = ''
-        if root is None or node['fullpath'].startswith(root):
-            mt = ''
-            if show_emoji:
-                if 'folder' in node['mimeType']:
-                    emoji = '📁'
-                elif 'zip' in node['mimeType'] or 'tar' in node['mimeType']:
-                    emoji = '🗜️'
-                elif 'image' in node['mimeType']:
-                    emoji = '🖼️'
-                elif 'pdf' in node['mimeType']:
-                    emoji = '🅿️'
-                elif 'sheet' in node['mimeType']:
-                    emoji = '🔢'
-                elif 'text' in node['mimeType']:
-                    emoji = '📄'
-                else:
-                    emoji = '📄'
-            response = (f"{indent_character * indent}{emoji}{node['fullpath']}\n")
-            for child in set(node['children']):
-                response += self._node_output(self.ids[child], indent=indent + 1, indent_character=indent_character)
-        return response
+    def _http(self):
+        '''authorized http object for the calling thread'''
+        if not hasattr(self._local, 'http'):
+            self._local.http = self.drive.auth.Get_Http_Object()
+        return self._local.http
+
+    def _throttle(self):
+        '''space out request starts across all threads to stay under the Drive per-user quota'''
+        with self._throttle_lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self.min_request_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    @staticmethod
+    def _status(e):
+        '''HTTP status and reason of a Drive error'''
+        if isinstance(e, ApiRequestError):
+            return e.error.get('code'), e.GetField('reason')
+        return e.resp.status, str(e)
+
+    def _retryable(self, e):
+        '''True for Drive errors which clear up on their own: rate limits and transient server errors'''
+        code, reason = self._status(e)
+        if code in [429, 500, 502, 503, 504]:
+            return True
+        return code == 403 and any(r in reason for r in NCSEFGoogleDrive.RATE_LIMIT_REASONS)
+
+    def _with_backoff(self, call, description, max_tries=6, created=None):
+        '''
+        make a Drive call, retrying with exponential backoff while Drive says to slow down
+
+        :param created: for calls which create a file, returns the file if it exists after all.  A server error can
+                        come back after the file was made, so this is asked before retrying one, rather than make
+                        a duplicate.
+        '''
+        for attempt in range(max_tries):
+            self._throttle()
+            try:
+                return call()
+            except (ApiRequestError, HttpError) as e:
+                if attempt == max_tries - 1 or not self._retryable(e):
+                    raise
+                if created is not None and self._status(e)[0] >= 500:
+                    item = created()
+                    if item is not None:
+                        self.logger.warning(f'{description}: {e}, but it was created')
+                        return item
+                delay = 2 ** attempt + random.random()
+                self.logger.warning(f'{description}: {e}, retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def _created(self, parentid, title):
+        '''
+        :return: the file titled title in the folder parentid on Drive, None if there isn't one
+        '''
+        query = f"'{parentid}' in parents and title = '{self._quote(title)}'"
+        return next(iter(self._list_query(query)), None)
+
+    @staticmethod
+    def _emoji(node):
+        if 'folder' in node['mimeType']:
+            emoji = '📁'
+        elif 'zip' in node['mimeType'] or 'tar' in node['mimeType']:
+            emoji = '🗜️'
+        elif 'image' in node['mimeType']:
+            emoji = '🖼️'
+        elif 'pdf' in node['mimeType']:
+            emoji = '🅿️'
+        elif 'sheet' in node['mimeType']:
+            emoji = '🔢'
+        elif 'text' in node['mimeType']:
+            emoji = '📄'
+        else:
+            emoji = '📄'
+        return emoji
 
     def _buildpath(self, node, path):
-        node['fullpath'] = f"{path}/{node['title']}"
-        for child in set(node['children']):
-            if child in self.ids.keys():
-                self._buildpath(self.ids[child], node['fullpath'])
-            else:
-                raise ValueError(f"{child} id not found under {node['title']}")
+        stack = [(node, path)]
+        while stack:
+            node, path = stack.pop()
+            node['fullpath'] = f"{path}/{node['title']}"
+            self._index_node(node)
+            for child in set(node['children']):
+                if child in self.ids.keys():
+                    stack.append((self.ids[child], node['fullpath']))
+                else:
+                    raise ValueError(f"{child} id not found under {node['title']}")
+
+    def _index_node(self, node):
+        '''keep the fullpath -> id and id -> parent lookups in step with a node'''
+        self.paths[node['fullpath']] = node['id']
+        self._dirty.add(node['id'])
+        self._deleted.discard(node['id'])
+        if len(node['parents']) > 0:
+            self.parent_ids[node['id']] = node['parents'][0]['id']
+        else:
+            self.parent_ids[node['id']] = None
+
+    def _add_node(self, item, fullpath):
+        '''add a newly created Drive item to the local cache, index and its parent's children'''
+        with self.lock:
+            node = DriveStore.slim(item)
+            node['fullpath'] = fullpath
+            self.ids[node['id']] = node
+            self._index_node(node)
+            parentid = self.parent_ids[node['id']]
+            if parentid in self.ids:
+                self.ids[parentid]['children'].append(node['id'])
+
+    def _lookup(self, fullpath):
+        '''id for a fullpath from the index, None if unknown, no longer cached, or since moved'''
+        nodeid = self.paths.get(fullpath)
+        if nodeid not in self.ids or self.ids[nodeid]['fullpath'] != fullpath:
+            return None
+        return nodeid
 
     def _write_cache(self):
-        fp = open(self.cache_file_name, 'w')
-        json.dump({'ids': self.ids,
-                   'last_updated': self.last_updated,
-                   'last_checked': self.last_checked}, fp, indent=2)
-        fp.close()
-
+        '''commit the rows changed since the last write to the local store'''
+        with self.lock:
+            self.store.flush(self.ids, self._dirty, self._deleted,
+                             {'change_token': self.change_token,
+                              'root': self.root,
+                              'last_updated': self.last_updated,
+                              'last_checked': self.last_checked,
+                              'last_full': self.last_full},
+                             self.uploads, self.local_md5, replace_all=self._replace_all)
+            self._dirty = set()
+            self._deleted = set()
+            self._replace_all = False
 
     def _find_file(self, fullpath, refresh=False):
-        found = False
         isafolder = False
         elements = fullpath.split('/')
         parentpath = '/'.join(elements[:-1])
         title = None
-        parentid = None
-        nodeid = None
-        nodedata = None
 
-        for id, data in self.ids.items():
-            if data['fullpath'] == parentpath:
-                parentid = id
-            if data['fullpath'] == fullpath:
-                found = True
-                nodeid = id
-                title = data['title']
-                nodedata = data
-                isafolder = data['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE
+        parentid = self._lookup(parentpath)
+        nodeid = self._lookup(fullpath)
+        found = nodeid is not None
+        if found:
+            title = self.ids[nodeid]['title']
+            isafolder = self.ids[nodeid]['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE
         if not found and refresh:
             self.list_all(force=True)
             nodeid, parentid, parentpath, title, isafolder = self._find_file(fullpath, refresh=False)
         return nodeid, parentid, parentpath, title, isafolder
 
-    def list_all(self, id=None, cache_checked_ttl=660, cache_update_ttl=21600, force=False):
-        try:
-            fp = open(self.cache_file_name, 'r')
-            cache = json.loads(fp.read())
-            fp.close()
-            cache_by_id = cache['ids']
-            last_updated = cache['last_updated']
-            last_checked = cache['last_checked']
-        except Exception as e:
-            print(f'error {e}')
+    def _service(self):
+        '''underlying Drive v2 API service from pydrive2, for calls pydrive2 doesn't wrap'''
+        if self.drive.auth.service is None:
+            self.drive.auth.Authorize()
+        return self.drive.auth.service
+
+    def _unindex_subtree(self, node):
+        '''drop the index entries for a node and everything below it'''
+        stack = [node]
+        while stack:
+            data = stack.pop()
+            if self.paths.get(data['fullpath']) == data['id']:
+                del self.paths[data['fullpath']]
+            stack.extend(self.ids[child] for child in data['children'] if child in self.ids)
+
+    def _unlink_node(self, node):
+        '''detach a node from its parents' children and the index, ahead of a move, rename or removal'''
+        for parent in node['parents']:
+            if parent['id'] in self.ids and node['id'] in self.ids[parent['id']]['children']:
+                self.ids[parent['id']]['children'].remove(node['id'])
+        self._unindex_subtree(node)
+
+    def _remove_node(self, fileid):
+        '''remove a trashed or deleted node, and its descendants, from the local cache'''
+        node = self.ids.get(fileid)
+        if node is None:
+            return
+        self._unlink_node(node)
+        stack = [node]
+        while stack:
+            data = stack.pop()
+            self.ids.pop(data['id'], None)
+            self.parent_ids.pop(data['id'], None)
+            self._dirty.discard(data['id'])
+            self._deleted.add(data['id'])
+            stack.extend(self.ids[child] for child in data['children'] if child in self.ids)
+
+    def _list_changes(self, change_token):
+        '''
+        fetch everything that changed on the Drive since change_token
+
+        :param change_token: page token saved from the previous listing
+        :return: list of change resources, token to use next time
+        '''
+        service = self._service()
+        changes = []
+        params = {'pageToken': change_token, 'includeDeleted': True, 'maxResults': 1000,
+                  'fields': f'items(fileId,deleted,file({NCSEFGoogleDrive.FILE_FIELDS},labels(trashed))),'
+                            f'nextPageToken,newStartPageToken'}
+        while True:
+            response = service.changes().list(**params).execute()
+            changes.extend(response.get('items', []))
+            if 'nextPageToken' in response:
+                params['pageToken'] = response['nextPageToken']
+            else:
+                return changes, response['newStartPageToken']
+
+    def _apply_changes(self, changes):
+        '''patch ids, children, fullpaths and the index in place from a list of Drive changes'''
+        touched = set()
+        previous = {}  # fullpaths of nodes whose parent is outside the cache, e.g. the root of a scoped listing
+        pending = changes
+        while pending:
+            # in a scoped listing a change can come before the change adding its parent folder, those wait for
+            # another pass, until a pass adds nothing new
+            waiting = {change['fileId'] for change in pending}
+            deferred = []
+            for change in pending:
+                fileid = change['fileId']
+                fileinfo = change.get('file')
+                if change.get('deleted') or fileinfo is None or fileinfo['labels']['trashed']:
+                    self._remove_node(fileid)
+                    touched.discard(fileid)
+                    continue
+                node = DriveStore.slim(fileinfo)
+                old = self.ids.get(fileid)
+                parentid = node['parents'][0]['id'] if len(node['parents']) else None
+                unmoved = old is not None and self.parent_ids.get(fileid) == parentid
+                if self.root is not None and parentid not in self.ids and not unmoved:
+                    if parentid in waiting and parentid != fileid:
+                        deferred.append(change)
+                        continue
+                    # outside the scoped subtree, or just moved out of it
+                    self._remove_node(fileid)
+                    touched.discard(fileid)
+                    continue
+                if old is not None:
+                    if unmoved and parentid not in self.ids:
+                        previous[fileid] = old['fullpath']
+                    self._unlink_node(old)
+                    node['children'] = old['children']
+                self.ids[fileid] = node
+                self._dirty.add(fileid)
+                touched.add(fileid)
+            if len(deferred) == len(pending):
+                # their parents never made it into the subtree
+                for change in deferred:
+                    self._remove_node(change['fileId'])
+                    touched.discard(change['fileId'])
+                break
+            pending = deferred
+
+        # relink to (possibly new) parents, then rebuild paths under anything that moved or was renamed
+        for fileid in touched:
+            for parent in self.ids[fileid]['parents']:
+                if parent['id'] in self.ids and fileid not in self.ids[parent['id']]['children']:
+                    self.ids[parent['id']]['children'].append(fileid)
+        for fileid in touched:
+            node = self.ids[fileid]
+            if node['modifiedDate'] > self.last_updated:
+                self.last_updated = node['modifiedDate']
+            if len(node['parents']) and node['parents'][0]['id'] in touched:
+                continue  # rebuilt along with its parent, whose fullpath may not be set yet
+            if len(node['parents']) == 0:
+                self._buildpath(node, '')
+            elif node['parents'][0]['id'] in self.ids:
+                self._buildpath(node, self.ids[node['parents'][0]['id']]['fullpath'])
+            elif fileid in previous:
+                self._buildpath(node, previous[fileid].rsplit('/', 1)[0])
+        return len(touched)
+
+    @staticmethod
+    def _quote(value):
+        '''escape a value for use inside single quotes in a Drive query'''
+        return value.replace('\\', '\\\\').replace("'", "\\'")
+
+    def _list_query(self, q=None, fields=None):
+        '''all non-trashed files matching a Drive query (everything if None), fetching only FILE_FIELDS'''
+        fields = fields or NCSEFGoogleDrive.FILE_FIELDS
+        params = {'q': f'({q}) and trashed=false' if q else 'trashed=false', 'maxResults': 1000, 'fields': f'items({fields}),nextPageToken'}
+        for file_list in self.drive.ListFile(params):
+            for fileinfo in file_list:
+                yield fileinfo
+
+    def _find_root(self, root):
+        '''
+        resolve a folder path to its id by walking down from the top level by title
+
+        :param root: fullpath of the folder
+        :return: Drive file resource for the folder
+        '''
+        elements = root.strip('/').split('/')
+        folder = f"mimeType = '{NCSEFGoogleDrive.FOLDER_MIME_TYPE}'"
+        candidates = list(self._list_query(f"title = '{self._quote(elements[0])}' and {folder}",
+                                           fields=NCSEFGoogleDrive.FILE_FIELDS.replace('parents(id)', 'parents(id,isRoot)')))
+        # top level for a service account is either My Drive or a folder shared with it whose parent it can't see
+        candidates = [c for c in candidates if len(c['parents']) == 0 or c['parents'][0].get('isRoot')]
+        if len(candidates) == 0:
+            raise ValueError(f'top level folder /{elements[0]} not found')
+        node = candidates[0]
+        for n, title in enumerate(elements[1:]):
+            matches = list(self._list_query(f"'{node['id']}' in parents and title = '{self._quote(title)}' and {folder}"))
+            if len(matches) == 0:
+                raise ValueError(f"folder /{'/'.join(elements[:n + 2])} not found")
+            node = matches[0]
+        return node
+
+    def _list_subtree(self, root):
+        '''
+        list a folder and everything under it, breadth first with batched "in parents" queries
+
+        :param root: fullpath of the folder
+        :return: dictionary of slimmed nodes by id, id of the root folder
+        '''
+        rootinfo = self._find_root(root)
+        cache_by_id = {rootinfo['id']: DriveStore.slim(rootinfo)}
+        frontier = [rootinfo['id']]
+        while frontier:
+            batch = frontier[:NCSEFGoogleDrive.PARENT_BATCH_SIZE]
+            frontier = frontier[NCSEFGoogleDrive.PARENT_BATCH_SIZE:]
+            for fileinfo in self._list_query(' or '.join(f"'{id}' in parents" for id in batch)):
+                cache_by_id[fileinfo['id']] = DriveStore.slim(fileinfo)
+                if fileinfo['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE:
+                    frontier.append(fileinfo['id'])
+        self.logger.info(f'listed {len(cache_by_id)} files under {root}')
+        return cache_by_id, rootinfo['id']
+
+    def _list_full(self):
+        '''re-list every non-trashed file on the Drive (or under root), rebuilding children, fullpaths and the index'''
+        # grab the change cursor first so anything modified during the listing shows up next time
+        self.change_token = self._service().changes().getStartPageToken().execute()['startPageToken']
+        if self.root is None:
             cache_by_id = {}
-            cache_by_tree = {}
-            last_updated = '1970-01-01T00:00:00.000Z'
-            last_checked = '1970-01-01T00:00:00.000Z'
-        utcnow = datetime.utcnow().replace(tzinfo=timezone.utc)
-        checked_delta = utcnow - parser.isoparse(last_checked)
-        updated_delta = utcnow - parser.isoparse(last_updated)
-
-        if force or checked_delta.total_seconds() > cache_checked_ttl or updated_delta.total_seconds() > cache_update_ttl:
-            self.logger.info(f'refetching file info, last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
-            last_checked = utcnow.isoformat()
-            for file_list in self.drive.ListFile({'q': 'trashed=false', 'maxResults': 500}):
-                for fileinfo in file_list:
-                    # if fileinfo['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE:
-                    #     pass
-                    # elif 'shortcut' in fileinfo['mimeType']:
-                    #     continue
-                    cache_by_id[fileinfo['id']] = fileinfo
-                    cache_by_id[fileinfo['id']]['children'] = []
-                    cache_by_id[fileinfo['id']]['fullpath'] = ''
+            for fileinfo in self._list_query():
+                cache_by_id[fileinfo['id']] = DriveStore.slim(fileinfo)
+            tops = [(id, '') for id, data in cache_by_id.items() if len(data['parents']) == 0]
         else:
-            self.logger.debug(
-                f'using cached file info, last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
+            cache_by_id, rootid = self._list_subtree(self.root)
+            tops = [(rootid, self.root.rsplit('/', 1)[0])]
 
         for id, data in cache_by_id.items():
-            if data['modifiedDate'] > last_updated:
-                last_updated = data['modifiedDate']
-
+            if data['modifiedDate'] > self.last_updated:
+                self.last_updated = data['modifiedDate']
             for parent in data['parents']:
                 if parent['id'] not in cache_by_id.keys():
                     continue  # likely in trash
                 cache_by_id[parent['id']]['children'].append(id)
 
         self.ids = cache_by_id
-        self.last_updated = last_updated
-        self.last_checked = last_checked
-
+        self.paths = {}
+        self.parent_ids = {}
+        self._deleted = set()
+        self._replace_all = True
         # add full path to all nodes, de-dupe children
         for id, data in cache_by_id.items():
-            if len(data['parents']) == 0:
-                self._buildpath(data, '')
             data['children'] = list(set(data['children']))
+        for id, prefix in tops:
+            self._buildpath(cache_by_id[id], prefix)
+
+    def list_all(self, id=None, cache_checked_ttl=660, cache_update_ttl=21600, force=False, incremental=True):
+        '''
+        load Drive file info from the local cache, refreshing it when stale
+
+        Once a full listing has been made, refreshes only fetch what changed since then (moves, renames, trashes
+        and deletes included) using the Drive changes feed.  A full listing is done when there is no cache or
+        cursor yet, when the cursor is rejected, when incremental is False, or every cache_update_ttl seconds as
+        a backstop.
+
+        :param cache_checked_ttl: seconds before the cache is checked for changes
+        :param cache_update_ttl: seconds before a full listing is forced
+        :param force: check for changes regardless of cache_checked_ttl
+        :param incremental: allow refreshing from the changes feed rather than a full listing
+        :return: nothing, updates ids, paths and parent_ids on the object
+        '''
+        if self.ids is None:
+            # first call, load what the local store has
+            self.ids = self.store.load_files()
+            self.paths = {}
+            self.parent_ids = {}
+            for data in self.ids.values():
+                self._index_node(data)
+            self._dirty = set()
+            meta = self.store.load_meta()
+            self.change_token = meta.get('change_token')
+            self.last_updated = meta.get('last_updated', '1970-01-01T00:00:00.000Z')
+            self.last_checked = meta.get('last_checked', '1970-01-01T00:00:00.000Z')
+            self.last_full = meta.get('last_full', '1970-01-01T00:00:00.000Z')
+            if meta.get('root') != self.root:
+                self.change_token = None  # cache was built for a different scope, start over
+            self.uploads = self.store.load_uploads()
+        utcnow = datetime.utcnow().replace(tzinfo=timezone.utc)
+        checked_delta = utcnow - parser.isoparse(self.last_checked)
+        full_delta = utcnow - parser.isoparse(self.last_full)
+
+        full = (not incremental or len(self.ids) == 0 or self.change_token is None
+                or full_delta.total_seconds() > cache_update_ttl)
+        if not full and (force or checked_delta.total_seconds() > cache_checked_ttl):
+            try:
+                changes, change_token = self._list_changes(self.change_token)
+            except HttpError as e:
+                self.logger.warning(f'change cursor {self.change_token} rejected ({e}), falling back to a full listing')
+                full = True
+            else:
+                patched = self._apply_changes(changes)
+                self.change_token = change_token
+                self.last_checked = utcnow.isoformat()
+                self.logger.info(f'patched {patched} changed file(s) from {len(changes)} change(s), '
+                                 f'last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
+                self._write_cache()
+                return
+
+        if full:
+            self.logger.info(f'refetching file info, last full listing {full_delta.total_seconds() / 60:.1f} minutes ago')
+            self._list_full()
+            self.last_checked = utcnow.isoformat()
+            self.last_full = self.last_checked
+        else:
+            self.logger.debug(
+                f'using cached file info, last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
 
         self._write_cache()
 
@@ -221,7 +586,218 @@ class NCSEFGoogleDrive(object):
 
         return shortcut
 
-    def create_file(self, localpath, remotepath, mimeType='application/vnd.google-apps.file', update_on='newer'):
+    def _upload(self, item, localpath, remotepath, created=None):
+        '''
+        send a local file's content to a Drive item on this thread's connection, backing off on rate limits
+
+        :param created: see _with_backoff, for an item which doesn't exist on Drive yet
+        :return: the item, or the Drive file resource if a failed attempt turned out to have created it
+        '''
+
+        def send():
+            item.SetContentFile(localpath)  # reopened on every attempt, a failed attempt leaves the stream consumed
+            item.Upload(param={'http': self._http()})
+            return item
+
+        return self._with_backoff(send, f'upload {remotepath}', created=created)
+
+    def _resumable_status(self, uri, size, remotepath):
+        '''
+        ask Drive how much of a resumable upload session it has received, an empty PUT with Content-Range */size
+
+        :param uri: session URI
+        :param size: bytes in the whole file
+        :param remotepath: for logging
+        :return: bytes received, and the Drive file resource if the upload had finished after all (else None)
+        :raises HttpError: 404 or 410 when the session has expired
+        '''
+
+        def query():
+            resp, content = self._http().request(uri, method='PUT', body='',
+                                                 headers={'Content-Length': '0', 'Content-Range': f'bytes */{size}'})
+            if resp.status not in [200, 201, 308]:
+                raise HttpError(resp, content, uri=uri)
+            return resp, content
+
+        resp, content = self._with_backoff(query, f'status of upload {remotepath}')
+        if resp.status in [200, 201]:
+            return size, json.loads(content)
+        received = resp.get('range')  # bytes=0-n, absent when nothing has arrived yet
+        return (int(received.rsplit('-', 1)[1]) + 1 if received else 0), None
+
+    def _upload_resumable(self, localpath, remotepath, mimeType=None, metadata=None, nodeid=None):
+        '''
+        send a large file in chunks over a Drive resumable upload session
+
+        The session URI and byte offset are saved in the cache after every chunk, so an upload interrupted by a
+        failure or a killed process picks up where it stopped on the next call for the same file, as long as the
+        local file hasn't changed in the meantime.
+
+        :param localpath: local filename
+        :param remotepath: full Drive path, the key for the saved session
+        :param mimeType: content type, guessed from the extension if None
+        :param metadata: file metadata when creating a new file
+        :param nodeid: id of the existing file when updating
+        :return: Drive file resource
+        '''
+        st = os.stat(localpath)
+        media = MediaFileUpload(localpath, mimetype=mimeType, chunksize=self.chunk_size, resumable=True)
+        if nodeid:
+            request = self._service().files().update(fileId=nodeid, media_body=media)
+        else:
+            request = self._service().files().insert(body=metadata, media_body=media)
+
+        session = self.uploads.get(remotepath)
+        if session and session['size'] == st.st_size and session['mtime'] == st.st_mtime:
+            # Drive may have more (or less) than was saved, ask it rather than trust the offset
+            try:
+                offset, response = self._resumable_status(session['uri'], st.st_size, remotepath)
+            except HttpError as e:
+                if e.resp.status not in [404, 410]:
+                    raise
+                self.logger.warning(f'upload session for {remotepath} expired, restarting')
+                with self.lock:
+                    self.uploads.pop(remotepath, None)
+                return self._upload_resumable(localpath, remotepath, mimeType, metadata, nodeid)
+            if response is not None:
+                with self.lock:
+                    self.uploads.pop(remotepath, None)
+                return response
+            self.logger.info(f"resuming upload of {remotepath} from byte {offset}")
+            request.resumable_uri = session['uri']
+            request.resumable_progress = offset
+        else:
+            session = {'localpath': localpath, 'size': st.st_size, 'mtime': st.st_mtime, 'uri': None, 'offset': 0}
+
+        response = None
+        while response is None:
+            try:
+                status, response = self._with_backoff(lambda: request.next_chunk(http=self._http()),
+                                                       f'upload {remotepath}')
+            except HttpError as e:
+                if session['uri'] is not None and e.resp.status in [404, 410]:
+                    # session expired on Drive's end, start over
+                    self.logger.warning(f'upload session for {remotepath} expired, restarting')
+                    with self.lock:
+                        self.uploads.pop(remotepath, None)
+                    return self._upload_resumable(localpath, remotepath, mimeType, metadata, nodeid)
+                raise
+            if response is None:
+                session['uri'] = request.resumable_uri
+                session['offset'] = status.resumable_progress
+                with self.lock:
+                    self.uploads[remotepath] = session
+                self._write_cache()
+                self.logger.debug(f'uploaded {status.progress() * 100:.0f}% of {remotepath}')
+
+        with self.lock:
+            self.uploads.pop(remotepath, None)
+        return response
+
+    def upload_files(self, files, max_workers=4, update_on='newer', desc='upload', md5s=None):
+        '''
+        upload many local files concurrently, creating the folders they need first
+
+        :param files: list of (localpath, remotepath) tuples
+        :param max_workers: number of uploads in flight at once
+        :param update_on: passed through to create_file
+        :param desc: label for the progress bar
+        :param md5s: dictionary of known digests by localpath.  Content is then uploaded once, files sharing a digest
+                     with one uploaded before them are copied from it on Drive, and create_file doesn't hash them again
+        :return: list of remote paths which failed to upload
+        '''
+        try:
+            self.create_folders({'/'.join(remotepath.split('/')[:-1]) for _, remotepath in files},
+                                max_workers=max_workers)
+        except Exception as e:
+            # create_file tries the missing folders again, file by file
+            self.logger.error(f'failed to create some folders ahead of the uploads: {e}')
+        md5s = md5s or {}
+
+        uploads = []
+        copies = []
+        first = {}  # md5 -> remote path its content is uploaded to
+        for localpath, remotepath in files:
+            md5 = md5s.get(localpath)
+            if md5 is not None and md5 in first:
+                copies.append(partial(self.copy_file, localpath, first[md5], remotepath, update_on=update_on, md5=md5))
+            else:
+                uploads.append(partial(self.create_file, localpath, remotepath, update_on=update_on, md5=md5))
+                if md5 is not None:
+                    first[md5] = remotepath
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool, tqdm(total=len(files), desc=desc) as bar:
+            # copies go once the uploads they copy are done
+            for batch in [uploads, copies]:
+                futures = {pool.submit(job): job.args[-1] for job in batch}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.logger.error(f'failed to upload {futures[future]}: {e}')
+                        failed.append(futures[future])
+                    bar.update(1)
+        self._write_cache()
+        return failed
+
+    def copy_file(self, localpath, source_remotepath, remotepath, update_on='newer', md5=None):
+        '''
+        put a local file on Drive by copying a Drive file already holding the same content, so the bytes aren't sent
+        again.  Falls back to create_file if the destination exists with other content or the source is missing.
+
+        :param localpath: local filename
+        :param source_remotepath: full Drive path of a file with the same content
+        :param remotepath: full Drive path, including title
+        :param update_on: passed through to create_file
+        :param md5: digest of localpath
+        :return: nothing
+        '''
+        nodeid, parentid, parentpath, title, isafolder = self._find_file(remotepath)
+        sourceid, _, _, _, _ = self._find_file(source_remotepath)
+        if nodeid and self.ids[nodeid].get('md5Checksum') == md5:
+            self.logger.debug(f'content unchanged, no update needed for {remotepath}')
+            return
+        if nodeid or sourceid is None:
+            return self.create_file(localpath, remotepath, update_on=update_on, md5=md5)
+        if not parentid:
+            parentid = self.create_folder(parentpath)['id']
+        body = {'title': remotepath.split('/')[-1], 'parents': [{'id': parentid}]}
+        item = self._with_backoff(
+            lambda: self._service().files().copy(fileId=sourceid, body=body,
+                                                 fields=NCSEFGoogleDrive.FILE_FIELDS).execute(http=self._http()),
+            f'copy {remotepath}', created=lambda: self._created(parentid, body['title']))
+        self._add_node(item, remotepath)
+        self.logger.info(f'created {remotepath}, copied from {source_remotepath}')
+
+    def _local_digest(self, localpath):
+        '''
+        md5 of a local file, from the saved hashes while its size and mtime are unchanged.  The hashing is done
+        against a copy of the file's entry so other workers and cache writes aren't held up while it reads the file.
+        '''
+        with self.lock:
+            hash_cache = {localpath: self.local_md5[localpath]} if localpath in self.local_md5 else {}
+        digest = file_md5(localpath, hash_cache)
+        with self.lock:
+            if self.local_md5.get(localpath) != hash_cache[localpath]:
+                self.local_md5[localpath] = hash_cache[localpath]
+        return digest
+
+    def create_file(self, localpath, remotepath, mimeType='application/vnd.google-apps.file', update_on='newer',
+                    md5=None):
+        '''
+        upload a local file to the given Drive path, creating or updating as needed
+
+        :param localpath: local filename
+        :param remotepath: full Drive path, including title
+        :param mimeType: used when one can't be inferred from the file extension
+        :param update_on: when the remote file already exists, 'newer' updates it if the local mtime is later,
+                          'checksum' updates it only if the content differs from Drive's md5Checksum,
+                          anything else always updates
+        :param md5: digest of localpath if already known, for 'checksum'
+        :return: nothing
+        :raises: the Drive error if the upload failed
+        '''
         nodeid, parentid, parentpath, title, isafolder = self._find_file(remotepath)
         upload = None
         if nodeid and update_on == 'newer':
@@ -230,6 +806,9 @@ class NCSEFGoogleDrive(object):
             localmtime = datetime.fromtimestamp(os.path.getmtime(localpath))
             localmtime = localmtime.replace(tzinfo=pytz.timezone('America/New_York'))
             upload = update_on == 'newer' and localmtime > remotemtime
+        elif nodeid and update_on == 'checksum':
+            remotemd5 = self.ids[nodeid].get('md5Checksum')
+            upload = remotemd5 is None or (md5 or self._local_digest(localpath)) != remotemd5
         else:
             upload = True
 
@@ -240,52 +819,131 @@ class NCSEFGoogleDrive(object):
                 self.logger.debug(f'creating {parentpath}')
                 parentitem = self.create_folder(parentpath)
                 parentid = parentitem['id']
+            large = os.path.getsize(localpath) >= self.resumable_threshold
             if nodeid:
-                item = self.drive.CreateFile({'id': nodeid})
-                item.SetContentFile(localpath)
-                item.Upload()
+                if large:
+                    item = self._upload_resumable(localpath, remotepath, nodeid=nodeid)
+                else:
+                    item = self.drive.CreateFile({'id': nodeid})
+                    self._upload(item, localpath, remotepath)
+                with self.lock:
+                    for attr in ['modifiedDate', 'md5Checksum']:
+                        if attr in item:
+                            self.ids[nodeid][attr] = item[attr]
+                    self._dirty.add(nodeid)
                 self.logger.info(f'updated {remotepath} {nodeid} from {localpath}')
             else:
                 for ext, mtype in NCSEFGoogleDrive.common_mime_types.items():
                     if localpath.endswith(f'.{ext}'):
                         mimeType = mtype
                 metadata = {"title": title, "parents": [{"id": parentid}], "mimeType": mimeType}
-                item = self.drive.CreateFile(metadata)
-                item.SetContentFile(localpath)
-                try:
-                    item.Upload()
-                except:
-                    print(localpath)
-                    pprint(metadata)
+                if large:
+                    item = self._upload_resumable(localpath, remotepath, mimeType=mimeType, metadata=metadata)
+                else:
+                    item = self._upload(self.drive.CreateFile(metadata), localpath, remotepath,
+                                        created=lambda: self._created(parentid, title))
+                self._add_node(item, remotepath)
                 self.logger.info(f'created {remotepath}')
+        elif update_on == 'checksum':
+            self.logger.debug(f'content unchanged, no update needed for {remotepath}')
         elif update_on == 'newer' and localmtime < remotemtime:
             self.logger.debug(f'no update needed for {remotepath}')
         else:
             self.logger.error('create_file unknown error')
 
+    def _new_folder(self, full_remote_path, parentid):
+        '''create a single folder on Drive, without touching the local cache'''
+        title = full_remote_path.split('/')[-1]
+        item = self.drive.CreateFile({"title": title, "parents": [{"id": parentid}],
+                                      "mimeType": NCSEFGoogleDrive.FOLDER_MIME_TYPE})
+
+        def send():
+            item.Upload(param={'http': self._http()})
+            return item
+
+        return self._with_backoff(send, f'create {full_remote_path}', created=lambda: self._created(parentid, title))
+
+    def create_folders(self, full_remote_paths, max_workers=4):
+        '''
+        "mkdir -p" for many folders at once.  Works out every folder missing from the requested paths and their
+        ancestors, then creates them a level at a time with each level's folders created concurrently.  A folder
+        which fails doesn't stop the others, the ones created are cached before the first failure is raised.
+
+        :param full_remote_paths: iterable of folder fullpaths, the top level folder must already exist
+        :param max_workers: number of folders created at once within a level
+        :return: dictionary of fullpath to folder id for every requested path and its ancestors
+        :raises: the Drive error of the first folder which couldn't be created
+        '''
+        with self.folder_lock:
+            with self.lock:
+                wanted = set()
+                for path in full_remote_paths:
+                    elements = path.rstrip('/').split('/')
+                    for n in range(2, len(elements) + 1):
+                        wanted.add('/'.join(elements[:n]))
+
+                result = {}
+                levels = {}
+                for path in wanted:
+                    nodeid = self._lookup(path)
+                    if nodeid is None:
+                        levels.setdefault(path.count('/'), []).append(path)
+                    elif self.ids[nodeid]['mimeType'] != NCSEFGoogleDrive.FOLDER_MIME_TYPE:
+                        raise ValueError(f"{path} already exists as a non-folder")
+                    else:
+                        result[path] = nodeid
+
+            # the lock isn't held while Drive creates them, lookups and uploads carry on meanwhile
+            errors = []
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for depth in sorted(levels.keys()):
+                    futures = {}
+                    for path in sorted(levels[depth]):
+                        parentpath = path.rsplit('/', 1)[0]
+                        if parentpath in result:
+                            futures[pool.submit(self._new_folder, path, result[parentpath])] = path
+                        elif depth == min(levels.keys()):
+                            raise ValueError(f'top level folder {path} not found')
+                        # otherwise its parent failed, and so does it
+                    for future in as_completed(futures):
+                        path = futures[future]
+                        try:
+                            item = future.result()
+                        except Exception as e:
+                            self.logger.error(f"failed to create {path}: {e}")
+                            errors.append(e)
+                            continue
+                        self._add_node(item, path)
+                        result[path] = item['id']
+                        self.logger.info(f"created {path} {item['id']}")
+            if len(levels):
+                self._write_cache()
+            if len(errors):
+                raise errors[0]
+        return result
+
     def create_folder(self, full_remote_path, expectedroot='Automation', refresh=False):
+        with self.folder_lock:  # check then create, don't let two threads make the same folder
+            return self._create_folder(full_remote_path, refresh=refresh)
+
+    def _create_folder(self, full_remote_path, refresh=False):
         item = {}
         nodeid, parentid, parentpath, title, isafolder = self._find_file(full_remote_path)
         if nodeid and not isafolder:
             self.logger.error(f"{full_remote_path} already exists as a non-folder")
         elif nodeid:
-            metadata = {"title": title, "parents": [{"id": parentid}], 'id': id}
+            metadata = {"title": title, "parents": [{"id": parentid}], 'id': nodeid}
             return metadata
         else:
             elements = full_remote_path.split('/')
             parentpath = '/'.join(elements[:-1])
             title = elements[-1]
             if parentid is None:
-                raise ValueError(f'parent folder {parentpath} not found')
-            metadata = {"title": title, "parents": [{"id": parentid}],
-                        "mimeType": NCSEFGoogleDrive.FOLDER_MIME_TYPE}
-            item = self.drive.CreateFile(metadata)
-            item.Upload()
+                parentid = self.create_folders([parentpath])[parentpath]
+            item = self._new_folder(full_remote_path, parentid)
 
             # update local cache
-            item['fullpath'] = full_remote_path
-            item['children'] = []
-            self.ids[item['id']] = item
+            self._add_node(item, full_remote_path)
             self._write_cache()
 
             parentid = item['id']
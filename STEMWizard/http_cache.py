@@ -0,0 +1,226 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from urllib.parse import urlencode, urlsplit, parse_qsl
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from logstuff import get_logger
+
+logger = get_logger('http_cache')
+
+# seconds a response stays fresh, by a substring of the URL.  Anything not listed here is never cached, which keeps
+# logins, CSRF scrapes, exports, downloads and setting changes going straight to STEM Wizard.
+DEFAULT_TTLS = {
+    'getstudentCustomMilestoneDetailView': 1800,
+    'studentFormsAndFilesDetailedView': 3600,
+    'ShowJudgesList': 3600,
+    'ShowStudentList': 3600,
+    'showVolunteerList': 3600,
+}
+LOGIN_PATH = '/admin/login'  # where STEM Wizard sends a request whose session has expired
+
+
+class ResponseCache(object):
+    '''
+    size bounded, least recently used SQLite store of responses from selected endpoints, keyed by method, URL and
+    normalized payload, and the identity logged in so one account never sees another's pages.  One store is shared
+    by every session in a SessionPool, so it serializes its own access.
+    '''
+
+    def __init__(self, filename='caches/http_cache.sqlite', ttls=None, max_bytes=256 * 1024 * 1024, identity=''):
+        '''
+        :param identity: who the responses are for, e.g. region domain and username
+        '''
+        self.identity = identity
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER,
+                               headers TEXT, content BLOB, stored_at REAL, accessed_at REAL, size INTEGER)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def ttl(self, url):
+        for endpoint, ttl in self.ttls.items():
+            if endpoint in url:
+                return ttl
+        return None
+
+    @staticmethod
+    def _normalize(fields):
+        if fields is None:
+            return ''
+        if isinstance(fields, (bytes, str)):
+            return fields if isinstance(fields, str) else fields.decode('utf-8', 'replace')
+        items = fields.items() if hasattr(fields, 'items') else fields
+        return urlencode(sorted((str(k), str(v)) for k, v in items))
+
+    def key(self, method, url, params, data):
+        parts = urlsplit(url)
+        query = sorted(parse_qsl(parts.query, keep_blank_values=True))
+        base = f"{parts.scheme}://{parts.netloc}{parts.path}?{urlencode(query)}"
+        raw = f"{self.identity} {method.upper()} {base} {self._normalize(params)} {self._normalize(data)}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT url, status, headers, content, stored_at FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is not None:
+                with self.db:
+                    self.db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return row
+
+    def store(self, key, r, url=None):
+        '''
+        :param url: URL requested.  A response which came through a redirect, from anywhere else or from the login
+                    page is what an expired session gets, and isn't kept.
+        '''
+        path = urlsplit(r.url).path
+        if r.history or LOGIN_PATH in path or (url is not None and urlsplit(url).path != path):
+            logger.debug(f"not caching {r.url}, redirected from {url}")
+            return
+        content = r.content
+        now = time.time()
+        with self.lock, self.db:
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (key, r.url, r.status_code, json.dumps(dict(r.headers)), content, now, now,
+                             len(content)))
+            self.total_bytes += len(content)
+            # evict least recently used until back under the size limit
+            while self.total_bytes > self.max_bytes:
+                victim = self.db.execute('SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1').fetchone()
+                if victim is None or victim[0] == key:
+                    break
+                self.db.execute('DELETE FROM responses WHERE key = ?', (victim[0],))
+                self.total_bytes -= victim[1]
+
+    def touch(self, key):
+        with self.lock, self.db:
+            self.db.execute('UPDATE responses SET stored_at = ? WHERE key = ?', (time.time(), key))
+
+    @staticmethod
+    def response(row):
+        url, status, headers, content, stored_at = row
+        r = requests.Response()
+        r.status_code = status
+        r.headers = CaseInsensitiveDict(json.loads(headers))
+        r._content = content
+        r.url = url
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.from_cache = True
+        return r
+
+    @staticmethod
+    def validators(row):
+        '''
+        :return: If-None-Match/If-Modified-Since headers to revalidate a stale entry, empty if it can't be revalidated
+        '''
+        cached_headers = CaseInsensitiveDict(json.loads(row[2]))
+        validators = {}
+        if 'ETag' in cached_headers:
+            validators['If-None-Match'] = cached_headers['ETag']
+        if 'Last-Modified' in cached_headers:
+            validators['If-Modified-Since'] = cached_headers['Last-Modified']
+        return validators
+
+    def invalidate(self, endpoint=None):
+        '''
+        drop cached responses so the next request for them goes to the server
+
+        :param endpoint: substring of the URLs to drop, None drops everything
+        :return: nothing
+        '''
+        with self.lock, self.db:
+            if endpoint is None:
+                self.db.execute('DELETE FROM responses')
+            else:
+                self.db.execute('DELETE FROM responses WHERE instr(url, ?) > 0', (endpoint,))
+            self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        logger.debug(f"invalidated cached responses for {endpoint or 'everything'}")
+
+    def close(self):
+        self.db.close()
+
+
+class CachingSession(requests.Session):
+    '''
+    requests.Session which serves GET and POST responses from cached endpoints out of a ResponseCache.  Fresh entries
+    are served without a request, stale ones are revalidated with If-None-Match/If-Modified-Since when the server
+    sent an ETag or Last-Modified.  Streamed requests always go to the server.
+    '''
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, params=None, data=None, headers=None, **kwargs):
+        ttl = self.cache.ttl(url)
+        if ttl is None or kwargs.get('stream') or method.upper() not in ['GET', 'POST']:
+            return super().request(method, url, params=params, data=data, headers=headers, **kwargs)
+
+        key = self.cache.key(method, url, params, data)
+        row = self.cache.load(key)
+        if row is not None:
+            if time.time() - row[4] < ttl:
+                logger.debug(f"serving {url} from cache")
+                return self.cache.response(row)
+            validators = self.cache.validators(row)
+            if validators:
+                headers = dict(headers or {}, **validators)
+
+        r = super().request(method, url, params=params, data=data, headers=headers, **kwargs)
+        if r.status_code == 304 and row is not None:
+            logger.debug(f"{url} not modified, serving from cache")
+            self.cache.touch(key)
+            return self.cache.response(row)
+        if r.status_code == 200:
+            self.cache.store(key, r, url)
+        r.from_cache = False
+        return r
+
+
+class SessionPool(object):
+    '''
+    one requests.Session per thread, all sharing a single cookie jar (so one login authenticates them all) and a
+    single ResponseCache.  Each session gets a connection pool sized for the pool, with keep-alive.
+    '''
+
+    def __init__(self, cache, size=10):
+        self.cache = cache
+        self.size = size
+        self.cookies = requests.cookies.RequestsCookieJar()  # CookieJar locks internally
+        self.sessions = weakref.WeakSet()  # a session goes away with the worker thread that used it
+        self._local = threading.local()
+
+    def get(self):
+        '''
+        :return: the calling thread's session, created on first use
+        '''
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = CachingSession(self.cache)
+            session.cookies = self.cookies
+            adapter = HTTPAdapter(pool_connections=self.size, pool_maxsize=self.size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._local.session = session
+            self.sessions.add(session)
+        return session
+
+    def close(self):
+        for session in list(self.sessions):
+            session.close()
+        self.cache.close()
@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import threading
+import time
+
+from fileutils import file_md5
+from logstuff import get_logger
+
+logger = get_logger('manifest')
+
+
+class Manifest(object):
+    '''
+    SQLite record of every student file downloaded: the project and file type it belongs to, where it came from (S3
+    URL or STEM Wizard filename), where it is, and its size, hash and S3 validators when it arrived.  The sync stages
+    ask this rather than the filesystem, verify() reconciles the two.  With a BlobStore, every file hashed is linked
+    into it so duplicate content is kept once.
+    '''
+    FIELDS = ['local_path', 'project', 'filetype', 'source', 'size', 'mtime', 'md5', 'etag', 'last_modified',
+              'downloaded']
+
+    def __init__(self, filename='caches/manifest.sqlite', root='files/ncsef', blobs=None):
+        '''
+        :param filename: SQLite database
+        :param root: directory local paths are relative to
+        :param blobs: blobs.BlobStore to deduplicate into, None keeps plain files
+        '''
+        self.filename = filename
+        self.root = root
+        self.blobs = blobs
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS files (local_path TEXT PRIMARY KEY, project TEXT,
+                               filetype TEXT, source TEXT, size INTEGER, mtime REAL, md5 TEXT, etag TEXT,
+                               last_modified TEXT, downloaded REAL)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_project_filetype ON files (project, filetype)')
+        self.entries = {row[0]: dict(zip(Manifest.FIELDS, row))
+                        for row in self.db.execute(f"SELECT {', '.join(Manifest.FIELDS)} FROM files")}
+        logger.debug(f'loaded {len(self.entries)} files from {filename}')
+
+    def get(self, local_path):
+        '''
+        :return: dictionary of FIELDS for a local path, None if it hasn't been downloaded
+        '''
+        return self.entries.get(local_path)
+
+    def for_project(self, project, filetype=None):
+        '''
+        :return: entries of a project, optionally of just one file type
+        '''
+        return [entry for entry in self.entries.values()
+                if entry['project'] == project and (filetype is None or entry['filetype'] == filetype)]
+
+    def md5s(self):
+        '''
+        :return: dictionary of md5 by full path, for the files which have been hashed
+        '''
+        return {f'{self.root}/{local_path}': entry['md5'] for local_path, entry in self.entries.items()
+                if entry['md5'] is not None}
+
+    def _hash(self, path):
+        ''' hash a file and link it into the blob store, :return: the digest and the file's stat afterwards '''
+        md5 = file_md5(path)
+        if self.blobs is not None:
+            self.blobs.adopt(path, md5)
+        return md5, os.stat(path)
+
+    def _put(self, entry):
+        with self.lock, self.db:
+            self.entries[entry['local_path']] = entry
+            self.db.execute(f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * len(Manifest.FIELDS))})",
+                            [entry[field] for field in Manifest.FIELDS])
+
+    def record(self, local_path, project, filetype, source, etag=None, last_modified=None, md5=True):
+        '''
+        records a file which has just arrived
+
+        :param local_path: path relative to root
+        :param project: project number
+        :param filetype: file type, as on the milestones
+        :param source: S3 URL or STEM Wizard filename
+        :param etag: S3 ETag, if any
+        :param last_modified: S3 Last-Modified, if any
+        :param md5: hash the file now, False to leave it for verify()
+        :return: the entry
+        '''
+        path = f'{self.root}/{local_path}'
+        digest, st = self._hash(path) if md5 else (None, os.stat(path))
+        entry = {'local_path': local_path, 'project': project, 'filetype': filetype, 'source': source,
+                 'size': st.st_size, 'mtime': st.st_mtime, 'md5': digest, 'etag': etag,
+                 'last_modified': last_modified, 'downloaded': time.time()}
+        self._put(entry)
+        return entry
+
+    def remove(self, local_path):
+        with self.lock, self.db:
+            self.entries.pop(local_path, None)
+            self.db.execute('DELETE FROM files WHERE local_path = ?', (local_path,))
+
+    def verify(self):
+        '''
+        reconciles the manifest against the disk: entries whose file is gone are dropped, files whose size or mtime
+        moved are hashed again, and files under root that nothing recorded are reported
+
+        :return: dictionary of lists of local paths, by missing, changed, hashed and untracked
+        '''
+        report = {'missing': [], 'changed': [], 'hashed': [], 'untracked': []}
+        for local_path, entry in list(self.entries.items()):
+            path = f'{self.root}/{local_path}'
+            if not os.path.isfile(path):
+                self.remove(local_path)
+                report['missing'].append(local_path)
+                continue
+            st = os.stat(path)
+            if entry['md5'] is not None and st.st_size == entry['size'] and st.st_mtime == entry['mtime']:
+                continue
+            if entry['md5'] is not None and self.blobs is not None:
+                # edited in place, through the link, so the old blob holds this content under the wrong name
+                self.blobs.forget(path, entry['md5'])
+            md5, st = self._hash(path)
+            report['changed' if entry['md5'] not in [None, md5] else 'hashed'].append(local_path)
+            self._put(dict(entry, size=st.st_size, mtime=st.st_mtime, md5=md5))
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                local_path = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if local_path not in self.entries and not filename.endswith(('.part', '.validator', '.link')):
+                    report['untracked'].append(local_path)
+        return report
+
+    def close(self):
+        self.db.close()
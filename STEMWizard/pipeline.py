@@ -0,0 +1,88 @@
+import queue
+import threading
+
+from logstuff import get_logger
+
+logger = get_logger('pipeline')
+
+_DONE = object()  # end of a stage's input
+
+
+class Pipeline(object):
+    '''
+    stages, each with its own worker threads, connected by bounded queues.  An item moves on to the next stage as soon
+    as a worker is done with it, and a stage whose input queue is full blocks the stage feeding it, so a slow stage
+    holds the others back rather than letting work pile up in memory.
+    '''
+
+    def __init__(self, queue_size=16):
+        '''
+        :param queue_size: items waiting between two stages before the earlier one blocks
+        '''
+        self.queue_size = queue_size
+        self.stages = []
+        self.failed = []
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def stage(self, name, function, workers=1):
+        '''
+        add a stage after those already added
+
+        :param name: for logging
+        :param function: called with each item, returns a list of items for the next stage, empty to drop the item
+        :param workers: threads running function
+        :return: the pipeline, so stages can be chained
+        '''
+        self.stages.append((name, function, workers))
+        return self
+
+    def _work(self, name, function, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                inbox.put(_DONE)  # pass it on to the stage's other workers
+                return
+            try:
+                results = function(item)
+            except Exception as e:
+                logger.error(f'{name} failed on {item}: {e}')
+                with self.lock:
+                    self.failed.append((name, item, repr(e)))
+                results = None
+            if outbox is not None and results:
+                for result in results:
+                    outbox.put(result)
+            elif self.finished is not None:
+                self.finished(name, item)
+
+    def run(self, items, finished=None):
+        '''
+        feed items to the first stage and wait until everything has come out of the last
+
+        :param items: iterable of items for the first stage
+        :param finished: called from the worker threads with the stage name and the item whenever an item goes no
+                         further, because the last stage is done with it, or a stage dropped it or raised on it
+        :return: list of (stage name, item, error) for the items a stage raised on
+        '''
+        self.finished = finished
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        workers = []
+        for n, (name, function, count) in enumerate(self.stages):
+            outbox = queues[n + 1] if n + 1 < len(queues) else None
+            threads = [threading.Thread(target=self._work, args=(name, function, queues[n], outbox),
+                                        name=f'{name}_{i}', daemon=True) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        for item in items:
+            queues[0].put(item)
+        queues[0].put(_DONE)
+        # a stage is finished once its input is and its workers have passed everything on
+        for n, threads in enumerate(workers):
+            for thread in threads:
+                thread.join()
+            if n + 1 < len(queues):
+                queues[n + 1].put(_DONE)
+        return self.failed
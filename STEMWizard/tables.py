@@ -0,0 +1,110 @@
+from io import BytesIO
+
+from lxml import etree, html
+
+FAIR_PREFIX = '2022 NCSEF '  # STEM Wizard prefixes our custom forms with this, drop it from labels
+
+# column headers on the judges materials and project milestones are long, match them to these
+SHORTNAMES = ['Research Paper', 'Abstract', 'Quad Chart', 'Lab Notebook ',
+              'Project Presentation Slides', '1 minute video', '1C', '7']
+
+DETAIL_TABLE_CLASS = 'table table-striped table-bordered table-hover dataTable'
+
+
+class MissingTableHead(ValueError):
+    '''
+    iter_table was asked to require a header row and the table had none
+    '''
+
+
+def cell_text(element):
+    '''
+    all of the text in an element and its descendants, equivalent to BeautifulSoup's .text
+    '''
+    return ''.join(element.itertext())
+
+
+def files_and_forms_label(th):
+    '''
+    column label on the files and forms milestone
+    '''
+    v = cell_text(th).strip()
+    v = v.replace(FAIR_PREFIX, '')
+    if 'Research' in v:
+        v = 'Research Plan'
+    if len(v) <= 2:
+        v = f"ISEF-{v.lower()}"
+    return v
+
+
+def milestone_label(th):
+    '''
+    column label on the judges materials and project milestones, where the header text is usually in a <p>
+    '''
+    p = th.find('.//p')
+    v = cell_text(p if p is not None else th).strip()
+    v = v.replace(FAIR_PREFIX, '')
+    for shortname in SHORTNAMES:
+        if shortname.lower() in v.lower():
+            v = shortname
+    return v.strip()  # remove stray whitespace in th text
+
+
+def file_type(contents):
+    '''
+    normalize a FILE TYPE cell on the student files and forms detail view to match the milestone labels
+    '''
+    contents = contents.replace(FAIR_PREFIX, '')
+    contents = contents.replace('Abstract Form', 'Abstract')
+    contents = contents.replace('ISEF ', 'ISEF-')
+    if 'Research Plan' in contents:
+        contents = 'Research Plan'
+    return contents
+
+
+def iter_table(text, label=cell_text, table_class=None, require_head=False):
+    '''
+    stream the rows of an html table as they are parsed, rather than building a tree for the whole page first.
+    Each row is detached from the tree once the next one is parsed, so rows the caller doesn't keep are freed and
+    memory stays flat on large pages.
+
+    :param text: html
+    :param label: function turning a th element into a column label
+    :param table_class: only read the first table with exactly this class attribute, None for any table
+    :param require_head: raise MissingTableHead if no header row is found
+    :return: generator of (labels, list of td elements, tr element) for each row with td cells
+    '''
+    labels = None
+    in_table = table_class is None
+    events = etree.iterparse(BytesIO(text.encode('utf-8')), events=('start', 'end'), tag=('table', 'tr'),
+                             html=True, encoding='utf-8')
+    for event, element in events:
+        if element.tag == 'table':
+            if table_class is not None and element.get('class') == table_class:
+                if event == 'end':
+                    break
+                in_table = True
+            continue
+        if event != 'end' or not in_table:
+            continue
+        # rows before this one have been handed out already, detach them so they go once the caller lets go.
+        # The rows themselves are never cleared, a caller may still be holding them.
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        ths = element.findall('th')
+        if len(ths) and labels is None:
+            labels = [label(th) for th in ths]
+        else:
+            tds = element.findall('td')
+            if len(tds):
+                yield labels, tds, element
+    if labels is None and require_head:
+        raise MissingTableHead('no table head found')
+
+
+def student_tab_ids(text):
+    '''
+    info ids from the student tabs (<li class="student_tab" id="64585">) on the detail view of a team project
+    '''
+    tree = html.fromstring(text)
+    return tree.xpath('//li[contains(concat(" ", normalize-space(@class), " "), " student_tab ")]/@id')
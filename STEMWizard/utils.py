@@ -1,9 +1,53 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
 from bs4 import BeautifulSoup
-from fileutils import read_json_cache, write_json_cache
+from requests.cookies import create_cookie
+from tqdm import tqdm
+
+import tables
+from categories import categories
 import os
 
-headers = {
-    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36'}
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36'
+ACCEPT_HTML = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9'
+
+_csrf_lock = threading.Lock()
+
+
+def _headers(self, referer=None, xhr=False, csrf=False, accept=None):
+    '''
+    headers for a single request, built fresh every time so nothing leaks between calls or worker threads
+
+    :param referer: Referer header, if any
+    :param xhr: mark the request as XMLHttpRequest, as the STEM Wizard pages do for their ajax calls
+    :param csrf: include the X-CSRF-TOKEN gathered at login
+    :param accept: Accept header, if any
+    :return: dictionary of headers
+    '''
+    headers = {'User-Agent': USER_AGENT}
+    if csrf:
+        headers['X-CSRF-TOKEN'] = self.csrf
+    if referer is not None:
+        headers['Referer'] = referer
+    if xhr:
+        headers['X-Requested-With'] = 'XMLHttpRequest'
+    if accept is not None:
+        headers['Accept'] = accept
+    return headers
+
+
+def _request(self, method, url, **kwargs):
+    '''
+    runs one request on the async client's event loop and waits for it, the synchronous face of AsyncClient.request
+
+    :return: requests.Response with the body read
+    '''
+    return self.aio.run(self.aio.request(method, url, **kwargs))
 
 
 def get_region_info(self):
@@ -12,7 +56,7 @@ def get_region_info(self):
     :return: nothing, updates region_id, region_domain, and token parameters in the object
     '''
     url = f'{self.url_base}/admin/login'
-    r = self.session.get(url, headers=headers, allow_redirects=True)
+    r = self._request('GET', url, headers=self._headers(), allow_redirects=True)
     if r.status_code >= 300:
         self.logger.error(f"status code {r.status_code} on post to {url}")
         return
@@ -40,22 +84,81 @@ def get_region_info(self):
         raise ValueError('region domain not found on login page')
 
 
+def _scrape_csrf(self, text):
+    csrf = BeautifulSoup(text, 'lxml').find('meta', {'name': 'csrf-token'})
+    if csrf is not None:
+        self.csrf = csrf.get('content')
+
+
 def get_csrf_token(self):
     '''
     ensures a valid cross site request forgery prevention token is on the object
     :return: nothing
     '''
-    if self.csrf is None:
+    with _csrf_lock:  # worker threads share the token, only one of them needs to fetch it
+        if self.csrf is None:
+            url = f'{self.url_base}/filesAndForms'
+            # a redirect to login here means login failed, there's nothing to log in again for
+            r = self._request('GET', url, headers=self._headers(), reauthenticate=False)
+            if r.status_code >= 300:
+                self.logger.error(f"status code {r.status_code} on post to {url}")
+                return
+            self._scrape_csrf(r.text)
+            self.logger.info(f"gathered CSRF token {self.csrf}")
+
+
+def _save_login_state(self):
+    '''
+    keeps the session cookies, tokens and region in a file only this user can read, so the next run can skip login
+    :return: nothing
+    '''
+    state = {'saved': time.time(), 'username': self.username, 'region_id': self.region_id, 'region_domain': self.region_domain,
+             'token': self.token, 'csrf': self.csrf,
+             'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'secure': c.secure,
+                          'expires': c.expires} for c in self.sessions.cookies]}
+    fd = os.open(self.session_cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+
+
+def _restore_login_state(self, probe=True):
+    '''
+    picks up the session saved by an earlier run, if it is younger than session_max_age and was saved for the same
+    username, in place of the login page, authenticate and CSRF requests
+
+    :param probe: check with one request that STEM Wizard still considers the session logged in
+    :return: True if the saved session was restored
+    '''
+    try:
+        with open(self.session_cache_file, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if time.time() - state.get('saved', 0) > self.session_max_age:
+        self.logger.info('saved STEM Wizard session is too old, logging in')
+        return False
+    if state.get('username') != self.username:
+        # the config changed accounts, the cookies and token are someone else's
+        self.logger.info(f"saved STEM Wizard session is for {state.get('username')}, not {self.username}, logging in")
+        return False
+    self.region_id = state['region_id']
+    self.region_domain = state['region_domain']
+    self.token = state['token']
+    self.csrf = state['csrf']
+    for cookie in state['cookies']:
+        self.sessions.cookies.set_cookie(create_cookie(**cookie))
+    if probe:
         url = f'{self.url_base}/filesAndForms'
-        r = self.session.get(url, headers=headers)
-        if r.status_code >= 300:
-            self.logger.error(f"status code {r.status_code} on post to {url}")
-            return
-        soup = BeautifulSoup(r.text, 'lxml')
-        csrf = soup.find('meta', {'name': 'csrf-token'})
-        if csrf is not None:
-            self.csrf = csrf.get('content')
-        self.logger.info(f"gathered CSRF token {self.csrf}")
+        r = self._request('GET', url, headers=self._headers(), allow_redirects=False, reauthenticate=False)
+        if r.status_code != 200:
+            self.logger.info(f'saved STEM Wizard session is no longer valid ({r.status_code}), logging in')
+            self.sessions.cookies.clear()
+            self.csrf = None
+            return False
+        self._scrape_csrf(r.text)  # the probe page carries a current token, keep it
+        self._save_login_state()  # still good, count its age from now
+    self.logger.info(f'restored STEM Wizard session saved {int(time.time() - state["saved"])} seconds ago')
+    return True
 
 
 def set_columns(self, listname='judge'):
@@ -71,9 +174,7 @@ def set_columns(self, listname='judge'):
     else:
         endpoint = f'fairadmin/{listname}'
     self.get_csrf_token()
-    headers['X-CSRF-TOKEN'] = self.csrf
-    headers['Referer'] = f'{self.url_base}f/fairadmin/{listname}'
-    headers['X-Requested-With'] = 'XMLHttpRequest'
+    headers = self._headers(referer=f'{self.url_base}f/fairadmin/{listname}', xhr=True, csrf=True)
 
     # https://ncregtest.stemwizard.com/fairadmin/showVolunteerList
     # https://ncregtest.stemwizard.com/fairadmin/showVolunteerList
@@ -123,7 +224,7 @@ def set_columns(self, listname='judge'):
         }
     elif listname == 'volunteer':
         url = f'{self.url_base}/fairadmin/showVolunteerList'
-        payload = {'per_page': 999,
+        payload = {'per_page': 50,  # only the column settings are read from this, not the volunteers
                    'page': 1,
                    'searchhere': '',
                    'registration_status': '', 'last_year': ''
@@ -172,32 +273,152 @@ def _merge_dicts(self, data):
                 data['all'][studentid]['files'] = data['all'][studentid]['files'] | studentdata['files']
             else:
                 data['all'] = data['all'] | studentdata
-    write_json_cache(data['all'], 'caches/student_data.json')
     return data
 
 
-def _download_to_local_file_path(self, full_pathname, r):
+def _fingerprint_students(self, data):
     '''
-    stream the given requests object to a local file
+    hashes each student's rows across the milestones, so a refresh can tell which students changed since the last
+    sync.  Call this before merging, which adds local file details to the rows.
 
-    :param full_pathname:
-    :param r:
-    :return:
+    :param data: dictionary of milestone name to dictionary of students
+    :return: dictionary of student id to hex digest
+    '''
+    rows = {}
+    for milestone in sorted(data.keys()):
+        for studentid, studentdata in data[milestone].items():
+            rows.setdefault(studentid, []).append([milestone, studentdata])
+    return {studentid: hashlib.sha1(json.dumps(r, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            for studentid, r in rows.items()}
+
+
+def _local_file_path(self, full_pathname):
+    '''
+    creates the directories for a file under the manifest's root, files/<domain>
+
+    :param full_pathname: path under the manifest's root
+    :return: path of the file
     '''
     atoms = full_pathname.split('/')
-    dir = f"files/{self.region_domain}"
+    dir = self.manifest.root
     for ele in atoms[:-1]:
         dir += f"/{ele}"
         os.makedirs(dir, exist_ok=True)
+    return f"{self.manifest.root}/{full_pathname}"
 
-    if r.status_code >= 300:
-        raise Exception(f'{r.status_code}')
-    if r.headers['Content-Type'] == 'text/html':
-        self.logger.error(f"failed to download {full_pathname}")
-    else:
-        f = open(f"files/{self.region_domain}/{full_pathname}", 'wb')
-        for chunk in r.iter_content(chunk_size=512 * 1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-        f.close()
-        self.logger.info(f"download_to_local_file_path: downloaded to {full_pathname}")
+
+def _download_to_local_file_path(self, full_pathname, method, url, data=None, headers=None):
+    '''
+    stream a request's response to a local file, on the async client's event loop
+
+    :param full_pathname: path under files/<region domain>
+    :param method: GET or POST
+    :param url: the url
+    :param data: form data for a POST
+    :param headers: request headers
+    :return: requests.Response with status and headers, the body is in the file
+    '''
+    r = self.aio.run(self.aio.download(method, url, self._local_file_path(full_pathname), data=data,
+                                       headers=headers))
+    if r.status_code < 300:
+        if r.headers.get('Content-Type') == 'text/html':
+            self.logger.error(f"failed to download {full_pathname}")
+        else:
+            self.logger.info(f"download_to_local_file_path: downloaded to {full_pathname}")
+    return r
+
+
+def _fetch_by_category(self, fetch, desc):
+    '''
+    runs a per category milestone fetch for every category, at most scrape_workers at a time, merging the results
+    in the order of the categories dictionary so the result (and the cache files written from it) is the same
+    regardless of which request finished first
+
+    :param fetch: function taking a category id and returning a dictionary of students
+    :param desc: progress bar label
+    :return: dictionary of students across all categories
+    '''
+    results = {}
+    with ThreadPoolExecutor(max_workers=self.scrape_workers) as pool:
+        futures = {pool.submit(fetch, category_id): category_id for category_id in categories.keys()}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            results[futures[future]] = future.result()
+    data = {}
+    for category_id in categories.keys():
+        data.update(results[category_id])
+    return data
+
+
+def _iter_pages(self, url, fields, label=tables.cell_text, in_query=False, page_size=None, require_head=False):
+    '''
+    streams the rows of a paginated STEM Wizard list or milestone view, page_size rows per request, handing each row
+    on as it is parsed.  Once a page has shown a full page of rows, the request for the next one goes out while the
+    rest of it is handled.  Stops at the first short page, or at a page repeating the one before it (a server
+    ignoring page).
+
+    The server may cap per_page below page_size, which a short first page can't tell apart from the last one.  While
+    the endpoint's cap is unknown, a short first page with more rows than any seen to be the last is followed by one
+    more request, and what that shows is remembered in page_limits, so later calls probe rarely if at all.
+
+    Pages are fetched on the async client's loop, whose STEM Wizard semaphore keeps concurrent fetchers within
+    scrape_workers requests.
+
+    :param url: endpoint
+    :param fields: request fields, page and per_page are added
+    :param label: passed to tables.iter_table
+    :param in_query: send fields in the query string rather than as form data, as the milestone views expect
+    :param page_size: rows per page, defaults to page_size from the config
+    :param require_head: passed to tables.iter_table for each page
+    :return: generator of (labels, td elements, tr element)
+    :raises requests.HTTPError: a page came back with an error status, rather than pass off the rows so far as all
+    '''
+    page_size = page_size or self.page_size
+    # (rows per page the server was seen to cap at, most rows seen on a short first page with nothing after it)
+    cap, last = self.page_limits.get((url, page_size), (None, 0))
+    full = cap or page_size  # rows in a full page
+    headers = self._headers(csrf=True)
+
+    def fetch(page):
+        page_fields = dict(fields, page=page, per_page=page_size)
+        if in_query:
+            return self.aio.submit(self.aio.request('POST', url, params=page_fields, headers=headers))
+        return self.aio.submit(self.aio.request('POST', url, data=page_fields, headers=headers))
+
+    page = 1
+    pending = fetch(page)
+    previous = None  # first row of the last page
+    probing = False
+    first_rows = 0  # rows on page 1
+    while pending is not None:
+        r = pending.result()
+        pending = None
+        if r.status_code >= 300:
+            raise requests.HTTPError(f"status code {r.status_code} on post to {url} page {page}", response=r)
+        count = 0
+        # an empty page past the end may not have a table at all
+        for row in tables.iter_table(r.text, label=label, require_head=require_head and not probing):
+            if count == 0:
+                first = [row[2].get('id')] + [tables.cell_text(td) for td in row[1]]
+                if first == previous:
+                    if not probing:
+                        self.logger.warning(f"{url} page {page} repeats page {page - 1}, stopping")
+                    else:
+                        self.page_limits[(url, page_size)] = (cap, max(last, first_rows))
+                    return
+                previous = first
+                if probing:
+                    cap = full = first_rows
+                    self.page_limits[(url, page_size)] = (cap, last)
+                    self.logger.warning(f"{url} sent {full} rows per page when asked for {page_size}, paging by {full}")
+            count += 1
+            if count == full:
+                pending = fetch(page + 1)  # there may be another page, ask now while the rest of these are handled
+            yield row
+        if probing and count == 0:
+            self.page_limits[(url, page_size)] = (cap, max(last, first_rows))
+        probing = False
+        if page == 1 and pending is None and cap is None and count > last:
+            first_rows = count
+            probing = True
+            pending = fetch(page + 1)
+        page += 1
@@ -40,12 +40,18 @@ class GoogleDriveSyncTestCases(unittest.TestCase):
 
     def test_drive_dump_specific_folder(self):
         uut = NCSEFGoogleDrive()
-        str = uut.dump('/Automation/ncsef/by category/SR', indent_character=".", show_emoji=True)
-        lines = str.split("\n")
+        lines = list(uut.walk('/Automation/ncsef/by category/SR', indent_character=".", show_emoji=True))
         self.assertNotEqual(len(uut.ids), len(lines))
         self.assertIn('📁/Automation/ncsef/by category/SR', lines)
         self.assertIn('.📁/Automation/ncsef/by category/SR/BSA', lines)
 
+    def test_drive_walk_depth_and_type(self):
+        uut = NCSEFGoogleDrive()
+        lines = list(uut.walk('/Automation/ncsef/by category', max_depth=1, mimetypes=['folder']))
+        self.assertIn('📁/Automation/ncsef/by category', lines)
+        self.assertIn(' 📁/Automation/ncsef/by category/SR', lines)
+        self.assertNotIn('  📁/Automation/ncsef/by category/SR/BSA', lines)
+
     def test_create_folder(self):
         uut = NCSEFGoogleDrive()
         # uut.list_all(cache_update_ttl=0)
@@ -64,6 +70,21 @@ class GoogleDriveSyncTestCases(unittest.TestCase):
 
         uut.list_all(cache_update_ttl=0)
 
+    def test_create_folders(self):
+        uut = NCSEFGoogleDrive()
+        data = {'ELE': ['BioS', 'Chem', 'EaEn', 'EnTe', 'PhyM'],
+                'JR': ['BSA', 'BSB', 'CHE', 'EES', 'ENG', 'MAT', 'PHY', 'TEC'],
+                'SR': ['BSA', 'BSB', 'CHE', 'EES', 'ENG', 'MAT', 'PHY', 'TEC']
+                }
+        paths = [f'/Automation/ncregtest/by category/{division}/{category}'
+                 for division, categories in data.items() for category in categories]
+        ids = uut.create_folders(paths)
+        for path in paths:
+            self.assertIn(path, ids)
+        self.assertEqual(ids['/Automation/ncregtest/by category/SR'], uut._lookup('/Automation/ncregtest/by category/SR'))
+        # everything exists now, so nothing more to create
+        self.assertEqual(ids, uut.create_folders(paths))
+
     def test_create_folder_full(self):
         uut = NCSEFGoogleDrive()
         uut.create_folder('/Automation/ncregtest/by internal id/53240')
@@ -122,6 +143,631 @@ class GoogleDriveSyncTestCases(unittest.TestCase):
         print(f"targetMimeType: {shortcut.get('targetMimeType')}")
 
 
+class TableParserTestCases(unittest.TestCase):
+    milestone_html = """
+    <table><thead><tr><th>Student</th><th><p>2022 NCSEF Quad Chart (PDF)</p></th><th>Lab Notebook (optional)</th></tr></thead>
+    <tbody>
+    <tr id="updatedStudentDiv_53240"><td><a href="/fairadmin/student/53240/view">Doe, Jane</a></td>
+        <td><a href="https://stem-s3-2021.s3.us-west-1.amazonaws.com/quad.pdf">quad.pdf</a></td><td>notebook.pdf</td></tr>
+    <tr id="updatedStudentDiv_53241"><td><div>Roe, Rick</div><div>Roe, Ruth</div></td><td></td><td></td></tr>
+    </tbody></table>
+    """
+
+    def test_milestone_labels_and_rows(self):
+        from STEMWizard.tables import iter_table, milestone_label, cell_text
+        rows = list(iter_table(self.milestone_html, label=milestone_label))
+        self.assertEqual(2, len(rows))
+        labels, tds, tr = rows[0]
+        self.assertEqual(['Student', 'Quad Chart', 'Lab Notebook'], labels)
+        self.assertEqual('updatedStudentDiv_53240', tr.get('id'))
+        self.assertEqual('Doe, Jane', cell_text(tds[0]).strip())
+        self.assertEqual('/fairadmin/student/53240/view', tds[0].find('.//a').get('href'))
+        labels, tds, tr = rows[1]
+        self.assertEqual(['Roe, Rick', 'Roe, Ruth'], [cell_text(div) for div in tds[0].findall('.//div')])
+
+    def test_files_and_forms_labels_and_file_types(self):
+        from STEMWizard.tables import iter_table, files_and_forms_label, file_type
+        html = "<table><tr><th>2022 NCSEF Research Plan</th><th>1b</th></tr><tr><td>x</td><td>y</td></tr></table>"
+        labels, tds, tr = next(iter_table(html, label=files_and_forms_label))
+        self.assertEqual(['Research Plan', 'ISEF-1b'], labels)
+        self.assertEqual('Abstract', file_type('2022 NCSEF Abstract Form'))
+        self.assertEqual('ISEF-1a', file_type('ISEF 1a'))
+
+    def test_require_head(self):
+        from STEMWizard.tables import iter_table
+        with self.assertRaises(ValueError):
+            list(iter_table("<p>session expired</p>", require_head=True))
+
+    def test_judges_materials_fixture(self):
+        from STEMWizard.tables import iter_table, milestone_label, cell_text
+        with open('fixtures/judges_materials_milestone.html', 'r') as f:
+            text = f.read()
+        rows = list(iter_table(text, label=milestone_label))
+        self.assertEqual(4, len(rows))
+        labels = rows[0][0]
+        self.assertEqual(['Quad Chart', 'Lab Notebook', 'Abstract'], labels[5:])
+        self.assertEqual([f'updatedStudentDiv_{n}' for n in range(53240, 53244)], [tr.get('id') for _, _, tr in rows])
+        self.assertEqual('SR-BSA-003', cell_text(rows[2][1][1]))
+        self.assertIsNone(rows[1][1][5].find('.//a'))
+        self.assertEqual('', cell_text(rows[3][1][6]))
+
+    def test_benchmark_against_beautifulsoup(self):
+        import time
+        from bs4 import BeautifulSoup
+        from STEMWizard.tables import iter_table, milestone_label
+        with open('fixtures/judges_materials_milestone.html', 'r') as f:
+            text = f.read()
+        # a full category of a few hundred students, the size that made per_page=999 pages slow
+        head, _, rest = text.partition('<tbody>')
+        body, _, tail = rest.partition('</tbody>')
+        text = f"{head}<tbody>{body * 100}</tbody>{tail}"
+
+        start = time.perf_counter()
+        streamed = sum(1 for _ in iter_table(text, label=milestone_label))
+        lxml_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        soup = BeautifulSoup(text, 'lxml')
+        parsed = len([tr for tr in soup.find('tbody').find_all('tr') if tr.find('td')])
+        soup_seconds = time.perf_counter() - start
+        self.assertEqual(parsed, streamed)
+        # the goal was 5x, leave room for a noisy machine
+        self.assertGreater(soup_seconds / lxml_seconds, 3,
+                           f"iter_table {lxml_seconds * 1000:.1f} ms, BeautifulSoup {soup_seconds * 1000:.1f} ms")
+
+
+class ResponseCacheTestCases(unittest.TestCase):
+    def setUp(self):
+        from STEMWizard.http_cache import ResponseCache
+        self.cache_file = 'caches/test_http_cache.sqlite'
+        self.cache = ResponseCache(filename=self.cache_file, ttls={'milestone': 60}, max_bytes=10)
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.cache_file)
+
+    def _response(self, url, content):
+        import requests
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r._content = content
+        r.headers['ETag'] = '"abc"'
+        return r
+
+    def test_key_normalizes_payload(self):
+        a = self.cache.key('post', 'https://x/milestone?b=2&a=1', None, {'page': 1, 'category_id': 5})
+        b = self.cache.key('POST', 'https://x/milestone?a=1&b=2', None, {'category_id': '5', 'page': '1'})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, self.cache.key('POST', 'https://x/milestone', None, {'page': 2}))
+        self.assertIsNone(self.cache.ttl('https://x/fairadmin/fileDownload'))
+
+    def test_lru_eviction_and_invalidate(self):
+        self.cache.store('one', self._response('https://x/milestone/1', b'123456'))
+        self.cache.store('two', self._response('https://x/milestone/2', b'123456'))
+        self.assertIsNone(self.cache.load('one'))
+        r = self.cache.response(self.cache.load('two'))
+        self.assertTrue(r.from_cache)
+        self.assertEqual('"abc"', r.headers['etag'])
+        self.cache.invalidate('milestone')
+        self.assertIsNone(self.cache.load('two'))
+        self.assertEqual(0, self.cache.total_bytes)
+
+    def test_login_pages_and_identity(self):
+        from STEMWizard.http_cache import ResponseCache
+        self.cache.max_bytes = 1024
+        self.cache.store('login', self._response('https://x/admin/login', b'<form>'), 'https://x/milestone')
+        self.cache.store('moved', self._response('https://x/elsewhere', b'<table>'), 'https://x/milestone')
+        self.assertIsNone(self.cache.load('login'))
+        self.assertIsNone(self.cache.load('moved'))
+        other = ResponseCache(filename=self.cache_file, ttls={'milestone': 60}, identity='ncregtest/someone')
+        self.assertNotEqual(self.cache.key('POST', 'https://x/milestone', None, {'page': 1}),
+                            other.key('POST', 'https://x/milestone', None, {'page': 1}))
+        other.close()
+
+
+class AsyncClientTestCases(unittest.TestCase):
+    def test_host_limits_and_form(self):
+        from STEMWizard.async_client import AsyncClient, _form
+        client = AsyncClient(cache=None, cookies=None, host_limits={'stemwizard.com': 3}, default_limit=6)
+
+        async def limits():
+            return (client._slot('https://ncsef.stemwizard.com/fairadmin/fileDownload')._value,
+                    client._slot('https://stem-s3-2021.s3.us-west-1.amazonaws.com/quad.pdf')._value)
+
+        self.assertEqual((3, 6), client.run(limits()))
+        client.close()
+        self.assertEqual({'page': '1', 'searchhere': ''}, _form({'page': 1, 'info_id': None, 'searchhere': ''}))
+
+    def test_expected_size(self):
+        from types import SimpleNamespace
+        from STEMWizard.async_client import AsyncClient
+        resumed = SimpleNamespace(status=206, headers={'Content-Range': 'bytes 1000-1999/2000'}, content_length=1000)
+        self.assertEqual(2000, AsyncClient._expected_size(resumed))
+        whole = SimpleNamespace(status=200, headers={}, content_length=2000)
+        self.assertEqual(2000, AsyncClient._expected_size(whole))
+        encoded = SimpleNamespace(status=200, headers={'Content-Encoding': 'gzip'}, content_length=700)
+        self.assertIsNone(AsyncClient._expected_size(encoded))
+
+    def test_resume_from_wrong_range_restarts(self):
+        import requests
+        from aiohttp import web
+        from STEMWizard.async_client import AsyncClient, IncompleteDownload
+
+        async def handler(request):
+            # ignores where the client asked to start
+            return web.Response(status=206, body=b'0123456789', headers={'Content-Range': 'bytes 0-9/10'})
+
+        client = AsyncClient(cache=None, cookies=requests.cookies.RequestsCookieJar())
+
+        async def serve():
+            app = web.Application()
+            app.router.add_get('/file', handler)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            return runner, runner.addresses[0][1]
+
+        runner, port = client.run(serve())
+        filename = 'caches/test_resume.pdf'
+        with open(f'{filename}.part', 'wb') as f:
+            f.write(b'01234')
+        with open(f'{filename}.part.validator', 'w') as f:
+            f.write('"abc"')
+        with self.assertRaises(IncompleteDownload):
+            client.run(client.download('GET', f'http://127.0.0.1:{port}/file', filename))
+        self.assertFalse(os.path.exists(f'{filename}.part'))
+        self.assertFalse(os.path.exists(filename))
+        client.run(runner.cleanup())
+        client.close()
+
+
+class IterPagesTestCases(unittest.TestCase):
+    def _api(self, pages):
+        '''stand-in for STEMWizardAPI serving pages, a function of page number and per_page returning ids'''
+        import logging
+        from concurrent.futures import Future
+        from types import SimpleNamespace
+        import requests
+
+        def request(method, url, params=None, data=None, headers=None):
+            fields = params or data
+            self.events.append(('request', fields['page']))
+            r = requests.Response()
+            r.status_code, ids = self.pages(fields['page'], fields['per_page'])
+            rows = ''.join(f'<tr id="{id}"><td>{id}</td></tr>' for id in ids)
+            r._content = f'<table><tr><th>Student</th></tr>{rows}</table>'.encode()
+            return r
+
+        def submit(r):
+            future = Future()
+            future.set_result(r)
+            return future
+
+        self.pages = pages
+        self.events = []
+        return SimpleNamespace(page_size=3, page_limits={}, logger=logging.getLogger('test'),
+                               _headers=lambda csrf: {}, aio=SimpleNamespace(request=request, submit=submit))
+
+    def _ids(self, api):
+        ids = []
+        for _, _, tr in STEMWizardAPI._iter_pages(api, 'https://x/milestone', {}):
+            self.events.append(('row', tr.get('id')))
+            ids.append(tr.get('id'))
+        return ids
+
+    def test_next_page_requested_before_the_last_row_is_handled(self):
+        students = [str(n) for n in range(5)]
+        api = self._api(lambda page, per_page: (200, students[(page - 1) * per_page:page * per_page]))
+        self.assertEqual(students, self._ids(api))
+        self.assertEqual([('request', 1), ('row', '0'), ('row', '1'), ('request', 2), ('row', '2'), ('row', '3'),
+                          ('row', '4')], self.events)
+
+    def test_pages_until_short(self):
+        students = [str(n) for n in range(7)]
+        api = self._api(lambda page, per_page: (200, students[(page - 1) * per_page:page * per_page]))
+        self.assertEqual(students, self._ids(api))
+
+    def test_server_ignoring_page(self):
+        api = self._api(lambda page, per_page: (200, ['1', '2', '3']))
+        self.assertEqual(['1', '2', '3'], self._ids(api))
+
+    def test_server_capping_per_page(self):
+        students = [str(n) for n in range(5)]
+        api = self._api(lambda page, per_page: (200, students[(page - 1) * 2:page * 2]))
+        self.assertEqual(students, self._ids(api))
+        self.assertEqual((2, 0), api.page_limits[('https://x/milestone', 3)])
+        # known now, a page short of the cap is the last without probing
+        self.events.clear()
+        self.pages = lambda page, per_page: (200, ['0'] if page == 1 else [])
+        self.assertEqual(['0'], self._ids(api))
+        self.assertEqual([('request', 1), ('row', '0')], self.events)
+
+    def test_short_pages_probe_rarely(self):
+        students = [str(n) for n in range(2)]
+        api = self._api(lambda page, per_page: (200, students[(page - 1) * per_page:page * per_page]))
+        self.assertEqual(students, self._ids(api))
+        self.assertEqual(2, len([event for event in self.events if event[0] == 'request']))
+        # no more rows than a page already seen to be the last, so no probe
+        for category in [students, students[:1]]:
+            self.events.clear()
+            self.pages = lambda page, per_page: (200, category[(page - 1) * per_page:page * per_page])
+            self.assertEqual(category, self._ids(api))
+            self.assertEqual(1, len([event for event in self.events if event[0] == 'request']))
+
+    def test_error_page_raises(self):
+        import requests
+        api = self._api(lambda page, per_page: (200, ['1', '2', '3']) if page == 1 else (500, []))
+        with self.assertRaises(requests.HTTPError):
+            self._ids(api)
+
+
+class LoginStateTestCases(unittest.TestCase):
+    def test_saved_session_is_for_one_username(self):
+        import logging
+        from types import SimpleNamespace
+        import requests
+        state_file = 'caches/test_session.json'
+
+        def api(username):
+            return SimpleNamespace(username=username, session_cache_file=state_file, session_max_age=3600,
+                                   region_id=7, region_domain='ncregtest', token='t' * 40, csrf='c',
+                                   logger=logging.getLogger('test'),
+                                   sessions=SimpleNamespace(cookies=requests.cookies.RequestsCookieJar()))
+
+        saved = api('fairadmin1')
+        saved.sessions.cookies.set('stemwizard_session', 'abc', domain='ncregtest.stemwizard.com')
+        STEMWizardAPI._save_login_state(saved)
+        try:
+            other = api('fairadmin2')
+            self.assertFalse(STEMWizardAPI._restore_login_state(other, probe=False))
+            self.assertEqual(0, len(other.sessions.cookies))
+            same = api('fairadmin1')
+            self.assertTrue(STEMWizardAPI._restore_login_state(same, probe=False))
+            self.assertEqual('abc', same.sessions.cookies.get('stemwizard_session'))
+        finally:
+            os.remove(state_file)
+
+
+class FingerprintTestCases(unittest.TestCase):
+    def test_fingerprint_students(self):
+        data = {'project': {'53240': {'Project Number': 'SR-BSA-001'}, '53241': {'Project Number': 'SR-BSA-002'}},
+                'file': {'53240': {'files': {'Abstract': {'url': ['https://x/abstract.pdf']}}}}}
+        before = STEMWizardAPI._fingerprint_students(None, data)
+        self.assertEqual({'53240', '53241'}, set(before.keys()))
+        data['file']['53240']['files']['Abstract']['url'].append('https://x/abstract2.pdf')
+        after = STEMWizardAPI._fingerprint_students(None, data)
+        self.assertNotEqual(before['53240'], after['53240'])
+        self.assertEqual(before['53241'], after['53241'])
+
+
+class DownloadManagerTestCases(unittest.TestCase):
+    def _manager(self, download, **kwargs):
+        '''DownloadManager on a stand-in api whose client downloads with the given coroutine function'''
+        import asyncio
+        import logging
+        from types import SimpleNamespace
+        from STEMWizard.downloads import DownloadManager
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        api = SimpleNamespace(logger=logging.getLogger('test'), _local_file_path=lambda filename: filename,
+                              manifest=SimpleNamespace(record=lambda *args: {'size': 1024 * 1024}),
+                              aio=SimpleNamespace(download=download, run=loop.run_until_complete))
+        return DownloadManager(api, backoff=0, **kwargs)
+
+    @staticmethod
+    def _response(status=200):
+        from types import SimpleNamespace
+        return SimpleNamespace(status_code=status, headers={})
+
+    def test_limits_per_source(self):
+        import asyncio
+        active = {'s3': 0, 'stemwizard': 0}
+        most = {'s3': 0, 'stemwizard': 0}
+
+        async def download(method, url, path, data=None, headers=None):
+            kind = 's3' if method == 'GET' else 'stemwizard'
+            active[kind] += 1
+            most[kind] = max(most[kind], active[kind])
+            await asyncio.sleep(0.01)
+            active[kind] -= 1
+            return self._response()
+
+        uut = self._manager(download, s3_workers=3, stemwizard_workers=1)
+        for n in range(6):
+            uut.add(('s3', f's3_{n}.pdf', 'SR-BSA-001', 'Abstract', 'url', 'GET', 'url', None, None))
+            uut.add(('stemwizard', f'sw_{n}.pdf', 'SR-BSA-001', '1C', 'f.pdf', 'POST', 'url', {}, {}))
+        self.assertEqual([], uut.run())
+        self.assertEqual({'s3': 3, 'stemwizard': 1}, most)
+        self.assertEqual(12, len(uut.downloaded))
+        self.assertGreater(uut.seconds, 0)
+
+    def test_retries_then_gives_up(self):
+        from STEMWizard.async_client import IncompleteDownload
+        attempts = []
+
+        async def download(method, url, path, data=None, headers=None):
+            attempts.append(path)
+            if path == 'flaky.pdf' and len(attempts) <= 2:
+                raise IncompleteDownload('short read') if len(attempts) == 1 else OSError('connection reset')
+            if path == 'down.pdf':
+                return self._response(503)
+            return self._response()
+
+        uut = self._manager(download, retries=2)
+        job = ('s3', 'flaky.pdf', 'SR-BSA-001', 'Abstract', 'url', 'GET', 'url', None, None)
+        self.assertEqual('downloaded', uut.fetch(job))
+        self.assertEqual(3, len(attempts))
+        attempts.clear()
+        job = ('s3', 'down.pdf', 'SR-BSA-001', 'Abstract', 'url', 'GET', 'url', None, None)
+        self.assertEqual('failed', uut.fetch(job))
+        self.assertEqual(3, len(attempts))
+        self.assertEqual([('down.pdf', 'status code 503')], uut.failed)
+        summary = uut.summary()
+        self.assertIn('downloaded 1 files, 1.0 MB', summary)
+        self.assertIn('0 unchanged, 1 failed', summary)
+
+
+class ManifestTestCases(unittest.TestCase):
+    def setUp(self):
+        from STEMWizard.manifest import Manifest
+        self.root = 'caches/test_manifest'
+        os.makedirs(f'{self.root}/SR/BSA', exist_ok=True)
+        self.manifest_file = 'caches/test_manifest.sqlite'
+        self.manifest = Manifest(self.manifest_file, root=self.root)
+
+    def tearDown(self):
+        import shutil
+        self.manifest.close()
+        os.remove(self.manifest_file)
+        shutil.rmtree(self.root)
+
+    def test_record_and_verify(self):
+        for name in ['SR-BSA-001_Abstract.pdf', 'SR-BSA-001_Quad Chart.pdf', 'stray.pdf']:
+            with open(f'{self.root}/SR/BSA/{name}', 'wb') as f:
+                f.write(name.encode())
+        entry = self.manifest.record('SR/BSA/SR-BSA-001_Abstract.pdf', 'SR-BSA-001', 'Abstract', 'https://x/a.pdf',
+                                     etag='"abc"')
+        self.assertEqual(len(b'SR-BSA-001_Abstract.pdf'), entry['size'])
+        self.assertIsNotNone(entry['md5'])
+        self.manifest.record('SR/BSA/SR-BSA-001_Quad Chart.pdf', 'SR-BSA-001', 'Quad Chart', None, md5=False)
+        self.assertEqual(1, len(self.manifest.for_project('SR-BSA-001', 'Abstract')))
+
+        os.remove(f'{self.root}/SR/BSA/SR-BSA-001_Abstract.pdf')
+        report = self.manifest.verify()
+        self.assertEqual(['SR/BSA/SR-BSA-001_Abstract.pdf'], report['missing'])
+        self.assertEqual(['SR/BSA/SR-BSA-001_Quad Chart.pdf'], report['hashed'])
+        self.assertEqual(['SR/BSA/stray.pdf'], report['untracked'])
+        self.assertIsNone(self.manifest.get('SR/BSA/SR-BSA-001_Abstract.pdf'))
+
+    def test_duplicates_share_a_blob(self):
+        from STEMWizard.blobs import BlobStore
+        self.manifest.blobs = BlobStore(f'{self.root}/blobs')
+        for name in ['SR-BSA-001_Abstract.pdf', 'SR-BSA-001_Abstract Form.pdf']:
+            with open(f'{self.root}/SR/BSA/{name}', 'wb') as f:
+                f.write(b'same upload')
+        a = self.manifest.record('SR/BSA/SR-BSA-001_Abstract.pdf', 'SR-BSA-001', 'Abstract', None)
+        b = self.manifest.record('SR/BSA/SR-BSA-001_Abstract Form.pdf', 'SR-BSA-001', 'Abstract Form', None)
+        self.assertEqual(a['md5'], b['md5'])
+        self.assertTrue(os.path.samefile(f'{self.root}/SR/BSA/SR-BSA-001_Abstract.pdf',
+                                         f'{self.root}/SR/BSA/SR-BSA-001_Abstract Form.pdf'))
+        self.assertEqual(3, os.stat(self.manifest.blobs.path(a['md5'])).st_nlink)
+        self.assertEqual(0, self.manifest.blobs.prune())
+
+    def test_adopt_when_another_worker_stores_the_blob_first(self):
+        from unittest import mock
+        from STEMWizard.blobs import BlobStore
+        blobs = BlobStore(f'{self.root}/blobs')
+        paths = [f'{self.root}/SR/BSA/{name}' for name in ['first.pdf', 'second.pdf']]
+        for path in paths:
+            with open(path, 'wb') as f:
+                f.write(b'same upload')
+        blobs.adopt(paths[0], 'abc123')
+        # the blob didn't exist when second checked, but did by the time it linked
+        real_exists = os.path.exists
+        with mock.patch('os.path.exists', side_effect=lambda p: False if p == blobs.path('abc123') else real_exists(p)):
+            self.assertTrue(blobs.adopt(paths[1], 'abc123'))
+        self.assertTrue(os.path.samefile(paths[0], paths[1]))
+
+
+class PipelineTestCases(unittest.TestCase):
+    def test_items_flow_through_stages(self):
+        from STEMWizard.pipeline import Pipeline
+
+        def split(n):
+            if n == 3:
+                raise ValueError('bad student')
+            return [(n, 'a'), (n, 'b')]
+
+        seen = []
+        uut = Pipeline(queue_size=1)
+        uut.stage('split', split).stage('upper', lambda item: [(item[0], item[1].upper())], workers=3)
+        uut.stage('collect', seen.append)
+        finished = []
+        failed = uut.run(range(5), finished=lambda stage, item: finished.append(stage))
+        self.assertEqual(8, len(seen))
+        self.assertEqual(['split'] + ['collect'] * 8, sorted(finished, reverse=True))
+        self.assertIn((4, 'B'), seen)
+        self.assertEqual([('split', 3, "ValueError('bad student')")], failed)
+
+
+class DriveStoreTestCases(unittest.TestCase):
+    def setUp(self):
+        self.filename = 'caches/test_drive_store.sqlite'
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(f'{self.filename}{suffix}'):
+                os.remove(f'{self.filename}{suffix}')
+
+    @staticmethod
+    def node(id, parent):
+        return {'id': id, 'title': f'{id}.pdf', 'parents': [{'id': parent}], 'mimeType': 'application/pdf',
+                'modifiedDate': '2022-01-01T00:00:00.000Z', 'md5Checksum': None, 'fullpath': f'/{id}.pdf',
+                'children': []}
+
+    def test_flush_and_load(self):
+        from STEMWizard.drive_store import DriveStore, DirtyDict
+        uut = DriveStore(self.filename)
+        ids = {id: self.node(id, 'top') for id in ['x', 'y', 'z']}
+        local_md5 = DirtyDict()
+        local_md5['files/a.pdf'] = {'size': 3, 'mtime': 1.5, 'md5': 'abc'}
+        uut.flush(ids, {'x', 'y'}, set(), {'change_token': 't1'}, {'/a.pdf': {'uri': 'https://u'}}, local_md5)
+        self.assertEqual({'x', 'y'}, set(uut.load_files()))  # only the dirty rows were written
+        self.assertEqual({'change_token': 't1'}, uut.load_meta())
+        self.assertEqual({'/a.pdf': {'uri': 'https://u'}}, uut.load_uploads())
+        self.assertEqual({'files/a.pdf': {'size': 3, 'mtime': 1.5, 'md5': 'abc'}}, uut.load_local_md5())
+        self.assertEqual(set(), local_md5.dirty)
+
+        # a hash not set again since the last flush isn't written again
+        dict.__setitem__(local_md5, 'files/b.pdf', {'size': 1, 'mtime': 2.0, 'md5': 'def'})
+        ids['y']['fullpath'] = '/moved/y.pdf'
+        uut.flush(ids, {'y', 'z'}, {'x'}, {'change_token': 't2'}, {}, local_md5)
+        files = uut.load_files()
+        self.assertEqual({'y', 'z'}, set(files))
+        self.assertEqual('/moved/y.pdf', files['y']['fullpath'])
+        self.assertEqual('t2', uut.load_meta()['change_token'])
+        self.assertEqual({}, uut.load_uploads())
+        self.assertNotIn('files/b.pdf', uut.load_local_md5())
+
+        ids = {'w': self.node('w', 'top'), 'v': self.node('v', 'w')}
+        uut.flush(ids, set(), set(), {}, {}, local_md5, replace_all=True)
+        files = uut.load_files()
+        self.assertEqual({'v', 'w'}, set(files))
+        self.assertEqual(['v'], files['w']['children'])
+        uut.close()
+
+
+class DriveChangesTestCases(unittest.TestCase):
+    # /Automation/ncsef/{by project/q2/y.pdf, old.pdf, gone.pdf}, as a scoped listing of /Automation saved it
+    tree = [('a0', 'Automation', 'top', '/Automation'),
+            ('a1', 'ncsef', 'a0', '/Automation/ncsef'),
+            ('a2', 'by project', 'a1', '/Automation/ncsef/by project'),
+            ('a3', 'q2', 'a2', '/Automation/ncsef/by project/q2'),
+            ('a4', 'y.pdf', 'a3', '/Automation/ncsef/by project/q2/y.pdf'),
+            ('a5', 'old.pdf', 'a1', '/Automation/ncsef/old.pdf'),
+            ('a6', 'gone.pdf', 'a1', '/Automation/ncsef/gone.pdf')]
+
+    def setUp(self):
+        from datetime import datetime, timezone
+        from unittest import mock
+        from STEMWizard.drive_store import DriveStore, DirtyDict
+        self.cache_file_name = 'caches/test_drive_changes.sqlite'
+        ids = {id: {'id': id, 'title': title, 'parents': [{'id': parent}], 'mimeType': self.mime(title),
+                    'modifiedDate': '2022-01-01T00:00:00.000Z', 'md5Checksum': None, 'fullpath': fullpath,
+                    'children': []}
+               for id, title, parent, fullpath in self.tree}
+        now = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
+        store = DriveStore(self.cache_file_name)
+        store.flush(ids, ids.keys(), [], {'change_token': 'token1', 'root': '/Automation', 'last_checked': now,
+                                          'last_full': now}, {}, DirtyDict())
+        store.close()
+        with mock.patch.object(NCSEFGoogleDrive, '_auth', return_value=None):
+            self.uut = NCSEFGoogleDrive(cache_file_name=self.cache_file_name, root='/Automation')
+
+    def tearDown(self):
+        self.uut.store.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(f'{self.cache_file_name}{suffix}'):
+                os.remove(f'{self.cache_file_name}{suffix}')
+
+    @staticmethod
+    def mime(title):
+        return 'application/pdf' if title.endswith('.pdf') else NCSEFGoogleDrive.FOLDER_MIME_TYPE
+
+    def change(self, id, title, parent, trashed=False):
+        return {'fileId': id, 'file': {'id': id, 'title': title, 'parents': [{'id': parent}],
+                                       'mimeType': self.mime(title), 'modifiedDate': '2022-02-01T00:00:00.000Z',
+                                       'labels': {'trashed': trashed}}}
+
+    # children come before the folders they moved into, which are only created later in the batch
+    changes = property(lambda self: [self.change('a3', 'q3', 'a2'),
+                                     self.change('a2', 'by project', 'n1'),
+                                     self.change('a5', 'old.pdf', 'a1', trashed=True),
+                                     self.change('a6', 'gone.pdf', 'elsewhere'),
+                                     self.change('n1', 'archive', 'a1')])
+
+    def test_apply_changes(self):
+        self.assertEqual(3, self.uut._apply_changes(self.changes))
+        self.assertEqual({'/Automation': 'a0', '/Automation/ncsef': 'a1', '/Automation/ncsef/archive': 'n1',
+                          '/Automation/ncsef/archive/by project': 'a2',
+                          '/Automation/ncsef/archive/by project/q3': 'a3',
+                          '/Automation/ncsef/archive/by project/q3/y.pdf': 'a4'}, self.uut.paths)
+        self.assertEqual({'a0', 'a1', 'a2', 'a3', 'a4', 'n1'}, set(self.uut.ids))
+        self.assertEqual({'a0': 'top', 'a1': 'a0', 'a2': 'n1', 'a3': 'a2', 'a4': 'a3', 'n1': 'a1'},
+                         self.uut.parent_ids)
+        self.assertEqual(['a2'], self.uut.ids['n1']['children'])
+        self.assertEqual('a2', self.uut._lookup('/Automation/ncsef/archive/by project'))
+
+    def test_incremental_listing_is_saved(self):
+        from unittest import mock
+        from STEMWizard.drive_store import DriveStore
+        with mock.patch.object(self.uut, '_list_changes', return_value=(self.changes, 'token2')) as list_changes:
+            self.uut.list_all(force=True)
+        list_changes.assert_called_once_with('token1')
+        store = DriveStore(self.cache_file_name)
+        files = store.load_files()
+        self.assertEqual({'a0', 'a1', 'a2', 'a3', 'a4', 'n1'}, set(files))
+        self.assertEqual('/Automation/ncsef/archive/by project/q3/y.pdf', files['a4']['fullpath'])
+        self.assertEqual(['a2'], files['n1']['children'])
+        self.assertEqual('token2', store.load_meta()['change_token'])
+        store.close()
+
+    def test_resume_upload_from_drives_offset(self):
+        import json
+        from unittest import mock
+        import httplib2
+        from googleapiclient.discovery import build
+        localpath = 'caches/test_resume_upload.bin'
+        content = os.urandom(300 * 1024)
+        with open(localpath, 'wb') as f:
+            f.write(content)
+        st = os.stat(localpath)
+        sent = []
+
+        class FakeHttp(object):
+            # Drive has the first 256KB of the saved session, then takes the rest
+            def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+                sent.append((uri, method, headers.get('Content-Range'), body.read() if body else b''))
+                if headers.get('Content-Range', '').startswith('bytes */'):
+                    return httplib2.Response({'status': '308', 'range': 'bytes=0-262143'}), b''
+                return httplib2.Response({'status': '200'}), json.dumps({'id': 'f1', 'title': 'big.bin'}).encode()
+
+        http = FakeHttp()
+        self.uut.uploads['/Automation/big.bin'] = {'localpath': localpath, 'size': st.st_size, 'mtime': st.st_mtime,
+                                                   'uri': 'https://upload.example/session1', 'offset': 0}
+        try:
+            with mock.patch.object(self.uut, '_service', return_value=build('drive', 'v2', http=http)), \
+                    mock.patch.object(self.uut, '_http', return_value=http):
+                item = self.uut._upload_resumable(localpath, '/Automation/big.bin', mimeType='application/octet-stream',
+                                                  metadata={'title': 'big.bin', 'parents': [{'id': 'a0'}]})
+        finally:
+            os.remove(localpath)
+        self.assertEqual('f1', item['id'])
+        self.assertEqual([('https://upload.example/session1', 'PUT', f'bytes */{st.st_size}', b''),
+                          ('https://upload.example/session1', 'PUT', f'bytes 262144-{st.st_size - 1}/{st.st_size}',
+                           content[262144:])], sent)
+        self.assertNotIn('/Automation/big.bin', self.uut.uploads)
+
+    def test_create_folders_keeps_those_made_before_a_failure(self):
+        from unittest import mock
+
+        def new_folder(path, parentid):
+            if path.endswith('/b'):
+                raise OSError('quota exceeded')
+            return {'id': path.rsplit('/', 1)[1], 'title': path.rsplit('/', 1)[1], 'parents': [{'id': parentid}],
+                    'mimeType': NCSEFGoogleDrive.FOLDER_MIME_TYPE}
+
+        with mock.patch.object(self.uut, '_new_folder', side_effect=new_folder):
+            with self.assertRaises(OSError):
+                self.uut.create_folders(['/Automation/ncsef/a', '/Automation/ncsef/b/x', '/Automation/ncsef/c'])
+        self.assertEqual('a', self.uut._lookup('/Automation/ncsef/a'))
+        self.assertEqual('c', self.uut._lookup('/Automation/ncsef/c'))
+        self.assertIsNone(self.uut._lookup('/Automation/ncsef/b'))
+        self.assertIsNone(self.uut._lookup('/Automation/ncsef/b/x'))
+        self.assertIn('c', self.uut.store.load_files())
+
+
 class NCSEF_prod_TestCases_operation(unittest.TestCase):
 
     def test_00_login(self):
@@ -256,7 +902,7 @@ class NCSEF_prod_TestCases(unittest.TestCase):
     def test_google_dump(self):
         uut = STEMWizardAPI(configfile=configfile_prod,
                             login_stemwizard=False, login_google=True)
-        print(uut.googleapi.dump('Automation'))
+        uut.googleapi.dump('/Automation')
 
     def test_treasruer_report(self):
         uut = STEMWizardAPI(configfile=configfile_prod,